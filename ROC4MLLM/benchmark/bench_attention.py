@@ -0,0 +1,79 @@
+"""Time and peak memory of the LLaMA attention backends (eager / sdpa / chunked) on a random model.
+
+The default length is a scoring prompt: ~100 prompt tokens + 65 image tokens + a ~60 token comment. Each backend
+runs in a fresh process so that the CPU peak (max RSS) of one does not hide the others; on CUDA the peak allocated
+memory is reported instead.
+
+    python -m benchmark.bench_attention --batch-size 32 --seq-len 225
+"""
+import argparse
+import multiprocessing
+import resource
+
+import torch
+
+from benchmark.common import tiny_model, timeit
+
+BACKENDS = ("eager", "sdpa", "chunked")
+
+
+def peak_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def measure(args, backend, queue):
+    device = torch.device(args.device)
+    model = tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.layers,
+                       num_attention_heads=args.heads, attention_backend=backend,
+                       attention_chunk_size=args.chunk_size).to(device)
+    if device.type == "cuda":
+        model.half()
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, 200, (args.batch_size, args.seq_len), device=device)
+
+    def forward():
+        with torch.inference_mode():
+            return model(input_ids=input_ids, use_cache=False, return_dict=True).logits[:, -1].float().cpu()
+
+    # the memory of the model and the inputs, measured before the first forward
+    base = peak_mb(device)
+    logits = forward()
+    seconds = timeit(forward, repeat=args.repeat)
+    # numpy, so the logits are pickled by value rather than shared with the exiting process
+    queue.put((backend, seconds, peak_mb(device) - base, logits.numpy()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seq-len", type=int, default=225)
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    results = {}
+    for backend in BACKENDS:
+        process = context.Process(target=measure, args=(args, backend, queue))
+        process.start()
+        name, seconds, peak, logits = queue.get()
+        process.join()
+        results[name] = (seconds, peak, torch.from_numpy(logits))
+
+    eager_seconds, _, eager_logits = results["eager"]
+    print(f"batch={args.batch_size} seq_len={args.seq_len} hidden={args.hidden_size} heads={args.heads} "
+          f"layers={args.layers} device={args.device}")
+    for backend, (seconds, peak, logits) in results.items():
+        print(f"{backend:8s} {1000 * seconds:8.1f} ms  peak +{peak:7.1f} MB  ({eager_seconds / seconds:.2f}x)  "
+              f"max |logit diff| {float((logits - eager_logits).abs().max()):.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Peak memory and time of a training step (forward + backward) with the text loss computed at once, in chunks
+(config.loss_chunk_size), and with config.sparse_logits, on a random model with a LLaMA-sized vocabulary.
+
+Each variant runs in a fresh process so that the CPU peak (max RSS) of one does not hide the others; on CUDA the
+peak allocated memory is reported instead.
+
+    python -m benchmark.bench_chunked_loss --batch-size 8 --seq-len 512 --chunk-size 128
+"""
+import argparse
+import multiprocessing
+import resource
+
+import torch
+
+from mplug_owl2.constants import IGNORE_INDEX
+from benchmark.common import tiny_model, timeit
+
+# name: (sparse_logits, chunked)
+VARIANTS = {"full": (False, False), "chunked": (False, True), "sparse": (True, False), "sparse+chunked": (True, True)}
+
+
+def peak_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def measure(args, name, queue):
+    device = torch.device(args.device)
+    sparse_logits, chunked = VARIANTS[name]
+    model = tiny_model(vocab_size=args.vocab_size, hidden_size=args.hidden_size).to(device)
+    model.config.sparse_logits = sparse_logits
+    model.config.loss_chunk_size = args.chunk_size if chunked else 0
+    model.config.num_tokens = 0
+    model.train()
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, 200, (args.batch_size, args.seq_len), device=device)
+    # the prompt half of every row is not supervised
+    labels = input_ids.masked_fill(torch.arange(args.seq_len, device=device) < args.seq_len // 2, IGNORE_INDEX)
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        loss = model(input_ids=input_ids, labels=labels, use_cache=False, return_dict=True).loss
+        loss.backward()
+        return loss.detach()
+
+    # the memory of the model and the inputs, measured before the first step
+    base = peak_mb(device)
+    loss = step()
+    grad = model.lm_head.weight.grad.float().cpu()
+    seconds = timeit(step, repeat=args.repeat)
+    queue.put((name, seconds, peak_mb(device) - base, float(loss), grad.numpy()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--seq-len", type=int, default=512)
+    parser.add_argument("--vocab-size", type=int, default=32011)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=128)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    results = {}
+    for name in VARIANTS:
+        process = context.Process(target=measure, args=(args, name, queue))
+        process.start()
+        name, seconds, peak, loss, grad = queue.get()
+        process.join()
+        results[name] = (seconds, peak, loss, torch.from_numpy(grad))
+
+    full_seconds, _, full_loss, full_grad = results["full"]
+    print(f"batch={args.batch_size} seq_len={args.seq_len} vocab={args.vocab_size} hidden={args.hidden_size} "
+          f"chunk={args.chunk_size} device={args.device}")
+    for name, (seconds, peak, loss, grad) in results.items():
+        print(f"{name:15s} {1000 * seconds:8.1f} ms  peak +{peak:8.1f} MB  ({full_seconds / seconds:.2f}x)  "
+              f"loss {loss:.6f}  max |lm_head grad diff| {float((grad - full_grad).abs().max()):.1e}")
+        assert abs(loss - full_loss) < 1e-5 * abs(full_loss), f"{name} changed the loss"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""greedy_generate, which drops finished rows from the batch, against model.generate, which pads them (CPU).
+
+The rows of the batch stop at different lengths, as comments do: a hook forces eos on a row when its greedy token
+hits a pseudo-random condition (about one step in --mean-length), independently of the other rows.
+
+    python -m benchmark.bench_early_exit --batch-size 16 --mean-length 60
+"""
+import argparse
+
+import torch
+
+from mplug_owl2.assessor import greedy_generate
+from mplug_owl2.mm_utils import BatchStoppingCriteria
+from benchmark.common import tiny_model, timeit
+
+
+class RandomEos:
+    def __init__(self, model, mean_length):
+        self.eos_token_id = model.config.eos_token_id
+        self.mean_length = mean_length
+        self.step = 0
+        model.lm_head.register_forward_hook(self)
+
+    def __call__(self, module, inputs, output):
+        if output.shape[1] > 1:
+            self.step = 0
+        self.step += 1
+        logits = output[:, -1]
+        # a per-row decision from the row's greedy token and the step, so it does not depend on which rows share
+        # the batch (unlike the exact logits, which change in the last bits with the batch size)
+        stop = (logits.argmax(dim=-1) * 7919 + self.step * 104729) % self.mean_length == 0
+        logits[:, self.eos_token_id] = torch.where(stop, logits.max(dim=-1).values + 1,
+                                                   torch.finfo(logits.dtype).min)
+        return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--prompt-len", type=int, default=165)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--mean-length", type=int, default=60)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.layers,
+                       max_position_embeddings=args.prompt_len + args.max_new_tokens)
+    RandomEos(model, args.mean_length)
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, 200, (args.batch_size, args.prompt_len))
+    eos_token_id = model.config.eos_token_id
+
+    def padded():
+        with torch.inference_mode():
+            return model.generate(input_ids, do_sample=False, max_new_tokens=args.max_new_tokens,
+                                  eos_token_id=eos_token_id, pad_token_id=0, use_cache=True)
+
+    def dropped():
+        with torch.inference_mode():
+            stopping = BatchStoppingCriteria(input_ids.shape[1], [eos_token_id])
+            return greedy_generate(model, input_ids, args.max_new_tokens, stopping, 0).sequences
+
+    reference, sequences = padded(), dropped()
+    assert torch.equal(reference, sequences), "dropping finished rows changed the output"
+    lengths = ((sequences[:, args.prompt_len:] == eos_token_id).int().argmax(dim=1) + 1).tolist()
+    padded_time = timeit(padded, repeat=args.repeat)
+    dropped_time = timeit(dropped, repeat=args.repeat)
+    print(f"batch={args.batch_size} generated lengths: min {min(lengths)} mean {sum(lengths) / len(lengths):.0f} "
+          f"max {max(lengths)}")
+    print(f"generate (padding finished rows): {1000 * padded_time:8.1f} ms")
+    print(f"greedy_generate (dropping them):  {1000 * dropped_time:8.1f} ms  ({padded_time / dropped_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Decoding with the preallocated StaticKVCache against the concatenated tuple cache (CPU).
+
+Greedy generation of --new-tokens tokens after a prompt on a random model; eos is suppressed so every run decodes
+the full length, as in a long comment:
+
+    python -m benchmark.bench_kv_cache --new-tokens 512 --layers 8
+"""
+import argparse
+
+import torch
+
+from benchmark.common import tiny_model, timeit
+
+
+class SuppressEos:
+    def __init__(self, model):
+        self.eos_token_id = model.config.eos_token_id
+        model.lm_head.register_forward_hook(self)
+
+    def __call__(self, module, inputs, output):
+        output[..., self.eos_token_id] = torch.finfo(output.dtype).min
+        return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--prompt-len", type=int, default=165)
+    parser.add_argument("--new-tokens", type=int, default=512)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.layers,
+                       max_position_embeddings=args.prompt_len + args.new_tokens)
+    SuppressEos(model)
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, 200, (args.batch_size, args.prompt_len))
+
+    def generate(static_cache_length=None):
+        with torch.inference_mode():
+            return model.generate(input_ids, do_sample=False, max_new_tokens=args.new_tokens, min_new_tokens=0,
+                                  use_cache=True, pad_token_id=0, static_cache_length=static_cache_length)
+
+    capacity = args.prompt_len + args.new_tokens
+    concat, static = generate(), generate(capacity)
+    assert torch.equal(concat, static), "static cache changed the greedy output"
+    concat_time = timeit(generate, repeat=args.repeat)
+    static_time = timeit(lambda: generate(capacity), repeat=args.repeat)
+    print(f"batch={args.batch_size} prompt={args.prompt_len} new_tokens={args.new_tokens} "
+          f"hidden={args.hidden_size} layers={args.layers}")
+    print(f"torch.cat cache: {1000 * concat_time / args.new_tokens:7.2f} ms/token")
+    print(f"static cache:    {1000 * static_time / args.new_tokens:7.2f} ms/token  ({concat_time / static_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
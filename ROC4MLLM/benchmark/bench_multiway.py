@@ -0,0 +1,71 @@
+"""MultiwayNetwork dispatch: contiguous-segment fast path against the per-token gather/scatter (CPU).
+
+Times the image prefill of a batch and one text decoding step on a small random model:
+
+    python -m benchmark.bench_multiway --hidden-size 512 --layers 8
+"""
+import argparse
+
+import torch
+
+from mplug_owl2.model import modeling_llama2
+from benchmark.common import tiny_model, IMAGE_SIZE, timeit
+
+
+class GatherLayout(modeling_llama2.MultiwayLayout):
+    # the dispatch before the fast path: always gather and scatter by token
+    def __init__(self, multiway_indices):
+        super().__init__(multiway_indices)
+        self.segments = None
+
+
+def run(model, input_ids, images, steps):
+    with torch.inference_mode():
+        outputs = model(input_ids=input_ids, images=images, use_cache=True, return_dict=True)
+        past, logits = outputs.past_key_values, [outputs.logits[:, -1]]
+        next_ids = logits[-1].argmax(-1, keepdim=True)
+        for _ in range(steps):
+            outputs = model(input_ids=next_ids, past_key_values=past, use_cache=True, return_dict=True)
+            past = outputs.past_key_values
+            logits.append(outputs.logits[:, -1])
+            next_ids = logits[-1].argmax(-1, keepdim=True)
+    return torch.stack(logits, dim=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.layers)
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, 200, (args.batch_size, 24))
+    input_ids[:, 6] = -200
+    images = torch.randn(args.batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+
+    fast = run(model, input_ids, images, args.steps)
+    fast_prefill = timeit(lambda: run(model, input_ids, images, 0), repeat=args.repeat)
+    fast_decode = (timeit(lambda: run(model, input_ids, images, args.steps), repeat=args.repeat) - fast_prefill)
+    modeling_llama2.MultiwayLayout, layout = GatherLayout, modeling_llama2.MultiwayLayout
+    try:
+        gather = run(model, input_ids, images, args.steps)
+        gather_prefill = timeit(lambda: run(model, input_ids, images, 0), repeat=args.repeat)
+        gather_decode = (timeit(lambda: run(model, input_ids, images, args.steps), repeat=args.repeat)
+                         - gather_prefill)
+    finally:
+        modeling_llama2.MultiwayLayout = layout
+
+    print(f"batch={args.batch_size} hidden={args.hidden_size} layers={args.layers} "
+          f"max |logit diff|={float((fast - gather).abs().max()):.2e}")
+    print(f"prefill      gather: {1000 * gather_prefill:7.2f} ms  segments: {1000 * fast_prefill:7.2f} ms  "
+          f"({gather_prefill / fast_prefill:.2f}x)")
+    print(f"decode/token gather: {1000 * gather_decode / args.steps:7.2f} ms  "
+          f"segments: {1000 * fast_decode / args.steps:7.2f} ms  ({gather_decode / fast_decode:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""model.score_logits (decoder + lm_head on the last position only) against the full forward, which projects every
+position onto the whole vocabulary, for prefill scoring (CPU).
+
+    python -m benchmark.bench_score_head --batch-size 16 --vocab-size 32011
+"""
+import argparse
+
+import torch
+
+from mplug_owl2.constants import IMAGE_TOKEN_INDEX
+from benchmark.common import tiny_model, timeit, IMAGE_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--prompt-len", type=int, default=100)
+    parser.add_argument("--vocab-size", type=int, default=32011)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = tiny_model(vocab_size=args.vocab_size, hidden_size=args.hidden_size)
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, 200, (args.batch_size, args.prompt_len))
+    input_ids[:, 1] = IMAGE_TOKEN_INDEX
+    input_ids[:, -1] = model.config.score_id
+    images = torch.randn(args.batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+
+    def full():
+        with torch.inference_mode():
+            return model(input_ids=input_ids, images=images, use_cache=False, return_dict=True).logits
+
+    def score_head():
+        with torch.inference_mode():
+            return model.score_logits(input_ids, images=images)
+
+    logits, score_logits = full(), score_head()
+    assert torch.allclose(logits[:, -1, -model.config.img_token_num:], score_logits, atol=1e-5), "score logits changed"
+    full_time = timeit(full, repeat=args.repeat)
+    head_time = timeit(score_head, repeat=args.repeat)
+    print(f"batch={args.batch_size} tokens={logits.shape[1]} vocab={args.vocab_size} hidden={args.hidden_size}")
+    print(f"full lm_head: {1000 * full_time:8.1f} ms  logits {logits.numel() * logits.element_size() / 2 ** 20:9.2f} MB")
+    print(f"score_head:   {1000 * head_time:8.1f} ms  logits "
+          f"{score_logits.numel() * score_logits.element_size() / 2 ** 20:9.4f} MB  ({full_time / head_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
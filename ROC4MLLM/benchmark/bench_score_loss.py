@@ -0,0 +1,85 @@
+"""The ROC loss block of MPLUGOwl2LlamaForCausalLM.forward: one gather of the [SCORE] logits and only the weighted
+losses, against the previous per-token slicing loop that also computed the unused KL and focal losses (CPU).
+
+Forward and backward of the loss over random logits, one [SCORE] token per sample, EMD, CE and L1 all weighted:
+
+    python -m benchmark.bench_score_loss --batch-sizes 16 64
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.nn import CrossEntropyLoss
+
+from benchmark.common import tiny_model, timeit
+
+
+def loop_score_loss(config, logits, labels, target, gt_score, score_weights):
+    # the loss block as it was before the gather, for reference
+    loss = logits.new_zeros(())
+    output_token_index = (labels == config.score_id).nonzero()
+    bs = labels.shape[0]
+    addon_index = torch.ones_like(output_token_index) * (-1)
+    addon_index[:, 0] = 0
+    output_token_index += addon_index
+    score_logits = []
+    for i in range(len(output_token_index)):
+        bs_id, seq_id = output_token_index[i]
+        score_logits.append(logits[bs_id:bs_id + 1, seq_id:seq_id + 1, :].view(1, -1))
+    score_logits = torch.cat(score_logits, dim=0)
+    score = torch.softmax(score_logits[:, -config.img_token_num:], dim=1)
+    target = target.view(-1, config.img_token_num)
+    cdf_diff = torch.cumsum(score, dim=1) - torch.cumsum(target, dim=1)
+    emd_loss = torch.sqrt(torch.mean(torch.pow(torch.abs(cdf_diff), 2))).mean()
+    loss = loss + config.emd_weight * emd_loss
+    ce_loss = CrossEntropyLoss()(score_logits[:, -config.img_token_num:], target)
+    loss = loss + config.ce_weight * ce_loss
+    kl_loss = nn.KLDivLoss(reduction="batchmean", log_target=True)(
+        F.log_softmax(score_logits[:, -config.img_token_num:], dim=1), F.softmax(target, dim=1))
+    bce_loss = F.binary_cross_entropy_with_logits(score_logits[:, -config.img_token_num:], target, reduction='none')
+    focal_loss = (0.25 * (1 - torch.exp(-bce_loss)) ** 2 * bce_loss).mean()
+    score = (score * score_weights).sum(dim=1).view(bs, -1)
+    l1_loss = nn.SmoothL1Loss()(score.view(-1), gt_score.view(-1))
+    return loss + config.l1_weight * l1_loss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--seq-len", type=int, default=32)
+    parser.add_argument("--vocab-size", type=int, default=32011)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    model = tiny_model(vocab_size=args.vocab_size)
+    config = model.config
+    config.emd_weight = config.ce_weight = config.l1_weight = 1.0
+    score_weights = model.get_score_weights("cpu")
+    for batch_size in args.batch_sizes:
+        torch.manual_seed(0)
+        logits = torch.randn(batch_size, args.seq_len, args.vocab_size, requires_grad=True)
+        labels = torch.randint(0, config.score_id, (batch_size, args.seq_len))
+        labels[torch.arange(batch_size), torch.randint(1, args.seq_len, (batch_size,))] = config.score_id
+        target = torch.softmax(torch.randn(batch_size, config.img_token_num), dim=1)
+        gt_score = torch.rand(batch_size, 1) * 9 + 1
+
+        def gathered():
+            rows, cols = (labels == config.score_id).nonzero(as_tuple=True)
+            loss = model.score_loss(logits[rows, cols - 1, -config.img_token_num:], target, gt_score)
+            return loss, torch.autograd.grad(loss, logits)[0]
+
+        def looped():
+            loss = loop_score_loss(config, logits, labels, target, gt_score, score_weights)
+            return loss, torch.autograd.grad(loss, logits)[0]
+
+        (loss, grad), (reference_loss, reference_grad) = gathered(), looped()
+        assert torch.allclose(loss, reference_loss) and torch.allclose(grad, reference_grad), "loss changed"
+        loop_time = timeit(looped, repeat=args.repeat)
+        gather_time = timeit(gathered, repeat=args.repeat)
+        print(f"batch={batch_size:3d} loop {1000 * loop_time:8.2f} ms  gather {1000 * gather_time:8.2f} ms  "
+              f"({loop_time / gather_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
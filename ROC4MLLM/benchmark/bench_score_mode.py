@@ -0,0 +1,39 @@
+"""Latency of Assessment(mode="score") against the full comment decode on a tiny random model (CPU)."""
+import argparse
+
+import torch
+from PIL import Image
+
+from mplug_owl2.assessor import Assessment
+from benchmark.common import tiny_model, ByteTokenizer, tiny_image_processor, ForceScoreToken, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--score-step", type=int, default=8,
+                        help="decode step at which the emulated model emits [SCORE]")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.set_num_threads(max(1, torch.get_num_threads()))
+    model = tiny_model()
+    assessment = Assessment(model=model, tokenizer=ByteTokenizer(model.config), image_processor=tiny_image_processor())
+    ForceScoreToken(model, args.score_step)
+    images = [Image.new("RGB", (64 + 8 * i, 48), (40 * i, 90, 160)) for i in range(args.batch_size)]
+
+    _, comment_scores = assessment(images, precision=4, mode="comment")
+    _, fast_scores = assessment(images, precision=4, mode="score")
+    assert comment_scores == fast_scores, (comment_scores, fast_scores)
+
+    comment = timeit(lambda: assessment(images, precision=4, mode="comment"), repeat=args.repeat)
+    score = timeit(lambda: assessment(images, precision=4, mode="score"), repeat=args.repeat)
+    print(f"batch={args.batch_size} scores={fast_scores}")
+    print(f"comment mode: {comment * 1000:8.1f} ms/batch")
+    print(f"score mode:   {score * 1000:8.1f} ms/batch  ({comment / score:.1f}x)")
+    constants = model.derived_constants
+    print(f"derived constants built: {dict(constants.allocations)}, reused: {dict(constants.hits)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Per-image cost of decode + expand2square + CLIP preprocessing against a TensorStore read.
+
+Uses the 448x448 CLIP preprocessing of the released checkpoint, on generated JPEGs unless -i is given:
+
+    python -m benchmark.bench_tensor_store -n 64
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from transformers.models.clip.image_processing_clip import CLIPImageProcessor
+
+from mplug_owl2.tensor_store import TensorStore
+
+
+def clip_448():
+    return CLIPImageProcessor(size={"shortest_edge": 448}, crop_size={"height": 448, "width": 448},
+                              image_mean=[0.48145466, 0.4578275, 0.40821073],
+                              image_std=[0.26862954, 0.26130258, 0.27577711])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--image_dir", type=str, default=None)
+    parser.add_argument("-n", "--num_images", type=int, default=64)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        if args.image_dir:
+            paths = sorted(os.path.join(args.image_dir, name) for name in os.listdir(args.image_dir))
+            paths = paths[:args.num_images]
+        else:
+            rng = np.random.default_rng(0)
+            paths = []
+            for i in range(args.num_images):
+                y, x = np.mgrid[0:768, 0:1024]
+                pixels = np.stack([x / 4 + i * 17, y / 3, (x + y) / 7], axis=-1) % 256
+                pixels = rng.normal(pixels, 6).clip(0, 255).astype(np.uint8)
+                paths.append(os.path.join(work_dir, f"{i}.jpg"))
+                Image.fromarray(pixels).save(paths[-1], quality=90)
+
+        store = TensorStore(os.path.join(work_dir, "store"), clip_448())
+        start = time.perf_counter()
+        reference = [store.preprocess(Image.open(path).convert('RGB')) for path in paths]
+        decode_time = (time.perf_counter() - start) / len(paths)
+
+        start = time.perf_counter()
+        for path in paths:
+            store.load(path)
+        fill_time = (time.perf_counter() - start) / len(paths)
+
+        # a new store object, as in the next run or another process
+        store = TensorStore(os.path.join(work_dir, "store"), store.image_processor)
+        start = time.perf_counter()
+        stored = [store.load(path) for path in paths]
+        read_time = (time.perf_counter() - start) / len(paths)
+
+        max_diff = max(float((a - b).abs().max()) for a, b in zip(reference, stored))
+        print(f"{len(paths)} images, store size {os.path.getsize(store.shard_path) / 2 ** 20:.1f} MB")
+        print(f"decode + preprocess: {1000 * decode_time:7.2f} ms/image")
+        print(f"first run (fill):    {1000 * fill_time:7.2f} ms/image")
+        print(f"store read:          {1000 * read_time:7.2f} ms/image  ({decode_time / read_time:.0f}x)")
+        print(f"max |fp32 - fp16 stored|: {max_diff:.5f}")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Tiny randomly initialised ROC4MLLM components for CPU benchmarks.
+
+Run the benchmarks from the ROC4MLLM folder, e.g. ``python -m benchmark.bench_score_mode``.
+"""
+import time
+
+import torch
+from transformers.models.clip.image_processing_clip import CLIPImageProcessor
+
+from mplug_owl2.model import MPLUGOwl2LlamaForCausalLM, MPLUGOwl2Config
+
+IMAGE_SIZE = 56
+NUM_TOKENS = 10
+
+
+def tiny_config(vocab_size=256, hidden_size=64, num_hidden_layers=2, num_attention_heads=4, **kwargs):
+    visual_config = {
+        "visual_model": dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+                             image_size=IMAGE_SIZE, patch_size=14),
+        "visual_abstractor": dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+                                  encoder_hidden_size=32, num_learnable_queries=8, grid_size=IMAGE_SIZE // 14),
+    }
+    config = MPLUGOwl2Config(visual_config=visual_config, vocab_size=vocab_size, hidden_size=hidden_size,
+                             intermediate_size=hidden_size * 2, num_hidden_layers=num_hidden_layers,
+                             num_attention_heads=num_attention_heads, **kwargs)
+    # same layout as train.py: [SCORE] followed by the [IMG*] tokens at the end of the vocabulary
+    config.num_tokens = NUM_TOKENS
+    config.img_token_num = NUM_TOKENS
+    config.score_id = vocab_size - NUM_TOKENS - 1
+    config.output_first_id = vocab_size - NUM_TOKENS
+    config.output_last_id = vocab_size - 1
+    config.min_score = 1
+    config.max_score = 10
+    config.l1_weight = 1.0
+    config.emd_weight = 0
+    config.ce_weight = 0
+    return config
+
+
+def tiny_model(seed=0, **kwargs):
+    torch.manual_seed(seed)
+    return MPLUGOwl2LlamaForCausalLM(tiny_config(**kwargs)).eval()
+
+
+class ByteTokenizer:
+    """Byte level stand-in for the LLaMA tokenizer, enough for prompt building and decoding."""
+    bos_token_id = 1
+    eos_token_id = 2
+    pad_token_id = 0
+
+    class _Encoding:
+        def __init__(self, input_ids):
+            self.input_ids = input_ids
+
+    def __init__(self, config):
+        self.score_id = config.score_id
+        self.num_text_ids = config.score_id - 3
+
+    def __call__(self, text):
+        input_ids = [self.bos_token_id]
+        for i, chunk in enumerate(text.split("[SCORE]")):
+            if i:
+                input_ids.append(self.score_id)
+            input_ids.extend(3 + b % self.num_text_ids for b in chunk.encode("utf-8"))
+        return self._Encoding(input_ids)
+
+    def decode(self, ids, skip_special_tokens=False):
+        ids = [int(i) for i in ids if 3 <= int(i) < 3 + self.num_text_ids or not skip_special_tokens]
+        return "".join(chr(32 + (i - 3) % 95) for i in ids)
+
+
+def tiny_image_processor():
+    return CLIPImageProcessor(size={"shortest_edge": IMAGE_SIZE}, crop_size={"height": IMAGE_SIZE, "width": IMAGE_SIZE})
+
+
+class ForceScoreToken:
+    """lm_head hook emulating a trained checkpoint: [SCORE] is emitted after `step` decode steps and eos never is."""
+
+    def __init__(self, model, step):
+        self.step = step
+        self.calls = 0
+        self.score_id = model.config.score_id
+        self.eos_token_id = model.config.eos_token_id
+        self.handle = model.lm_head.register_forward_hook(self)
+
+    def __call__(self, module, inputs, output):
+        if output.shape[1] > 1:
+            self.calls = 0
+        output[..., self.eos_token_id] = torch.finfo(output.dtype).min
+        if self.calls == self.step:
+            output[:, -1, self.score_id] = output[:, -1].max() + 1
+        self.calls += 1
+        return output
+
+
+class ForceAnswer:
+    """lm_head hook forcing the greedy answer to `token_ids` followed by [SCORE], without touching the [IMG*] logits."""
+
+    def __init__(self, model, token_ids):
+        self.token_ids = list(token_ids) + [model.config.score_id]
+        self.calls = 0
+        self.handle = model.lm_head.register_forward_hook(self)
+
+    def __call__(self, module, inputs, output):
+        if output.shape[1] > 1:
+            self.calls = 0
+        if self.calls < len(self.token_ids):
+            output[:, -1, self.token_ids[self.calls]] = output[:, -1].max() + 1
+        self.calls += 1
+        return output
+
+
+def timeit(fn, repeat=3, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
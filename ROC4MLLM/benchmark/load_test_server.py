@@ -0,0 +1,130 @@
+"""Load test of server.py with a stub model, to measure the request overhead around the model.
+
+The stub replaces Assessment before server.py is imported, so no checkpoint is needed. The same uploads
+are sent to /api/roc4mllm, which decodes in memory, and to a /legacy route that goes through a temp file
+like the original handler. Both routes then go through the same batch scheduler.
+
+    python -m benchmark.load_test_server -n 400 -c 32
+"""
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import mplug_owl2.assessor
+
+
+class StubAssessment:
+    def __init__(self, *args, model_time_ms=20, **kwargs):
+        self.model_time = model_time_ms / 1000
+
+    def __call__(self, images, precision=4, mode="comment"):
+        time.sleep(self.model_time)
+        scores = [round(float(np.asarray(img.resize((8, 8))).mean()) / 25.5, precision) for img in images]
+        return [f"The aesthetic rate of the image is {score}." for score in scores], scores
+
+
+def make_jpeg(width, height, seed=0):
+    # smooth gradients plus mild noise compress to photo-like file sizes, pure noise would not
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x / 4 + seed * 17, y / 3, (x + y) / 7], axis=-1) % 256
+    pixels = np.random.default_rng(seed).normal(pixels, 6).clip(0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def legacy_decode(data):
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
+        tmp_file.write(data)
+        temp_file_path = tmp_file.name
+    try:
+        return Image.open(temp_file_path).convert('RGB')
+    finally:
+        os.unlink(temp_file_path)
+
+
+def add_legacy_route(server):
+    from fastapi import UploadFile, File
+
+    @server.app.post("/legacy")
+    async def legacy(file: UploadFile = File(...)):
+        # the original handler: temp file round-trip, decoded on the event loop
+        img = legacy_decode(await file.read())
+        answer, score = await asyncio.wrap_future(server.scheduler.submit(img))
+        return {"score": score, "comment": answer}
+
+
+def time_decode(decode, payloads):
+    start = time.perf_counter()
+    for data in payloads:
+        decode(data)
+    return 1000 * (time.perf_counter() - start) / len(payloads)
+
+
+def run(client, route, payloads, concurrency):
+    def post(data):
+        start = time.perf_counter()
+        response = client.post(route, files={"file": ("image.jpg", data, "image/jpeg")})
+        assert response.status_code == 200, response.text
+        return time.perf_counter() - start, response.json()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(post, payloads))
+    total = time.perf_counter() - start
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "images/s": len(payloads) / total,
+        "p50 ms": 1000 * statistics.median(latencies),
+        "p95 ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+    }, [result for _, result in results]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_requests", type=int, default=400)
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    parser.add_argument("--size", type=int, nargs=2, default=(1024, 768), help="width height of the uploads")
+    parser.add_argument("--model_time_ms", type=float, default=20, help="stub forward time per batch")
+    args = parser.parse_args()
+
+    mplug_owl2.assessor.Assessment = lambda *a, **kw: StubAssessment(model_time_ms=args.model_time_ms)
+    import server
+    from fastapi.testclient import TestClient
+    add_legacy_route(server)
+
+    payloads = [make_jpeg(*args.size, seed=i % 8) for i in range(args.num_requests)]
+    with TestClient(server.app) as client:
+        run(client, "/api/roc4mllm", payloads[:args.concurrency], args.concurrency)
+        stats = {}
+        for route in ("/legacy", "/api/roc4mllm"):
+            stats[route], results = run(client, route, payloads, args.concurrency)
+            if route == "/legacy":
+                reference = results
+        assert results == reference, "in-memory decoding changed the responses"
+        print(f"{args.num_requests} uploads of {args.size[0]}x{args.size[1]} "
+              f"({len(payloads[0]) // 1024} KB), concurrency {args.concurrency}")
+        print(f"decode only: temp file {time_decode(legacy_decode, payloads[:50]):.2f} ms/image, "
+              f"in memory {time_decode(server.load_image_from_bytes, payloads[:50]):.2f} ms/image")
+        for route, route_stats in stats.items():
+            print(f"{route:15s} " + "  ".join(f"{k}: {v:7.1f}" for k, v in route_stats.items()))
+
+        buf = io.BytesIO()
+        Image.new("RGB", (9000, 8000)).save(buf, format="JPEG")
+        too_large = buf.getvalue()
+        server.MAX_IMAGE_PIXELS = 50_000_000
+        print("oversized image:", client.post("/api/roc4mllm", files={"file": ("big.jpg", too_large)}).status_code)
+        print("undecodable:", client.post("/api/roc4mllm", files={"file": ("bad.jpg", b"not an image")}).status_code)
+        print("scheduler:", client.get("/api/metrics").json())
+
+
+if __name__ == "__main__":
+    main()
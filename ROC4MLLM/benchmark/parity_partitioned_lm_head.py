@@ -0,0 +1,101 @@
+"""Parity of the training losses when lm_head.weight is only materialised inside lm_head's forward, as under
+DeepSpeed ZeRO-3 (scripts/finetune.sh), where the raw parameter is an empty placeholder outside forward.
+
+During the forward pass the weight of a random model is swapped for an empty tensor, and forward hooks restore it
+for the duration of every lm_head call. The full, chunked (config.loss_chunk_size), sparse (config.sparse_logits)
+and sparse + chunked losses, their lm_head gradients, and model.score_logits must then match the unpartitioned
+model; any code path that reads lm_head.weight directly fails on the empty placeholder.
+
+    python -m benchmark.parity_partitioned_lm_head
+"""
+import argparse
+import contextlib
+
+import torch
+
+from mplug_owl2.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from benchmark.common import tiny_model, IMAGE_SIZE
+
+# name: (sparse_logits, chunked)
+VARIANTS = {"full": (False, False), "chunked": (False, True), "sparse": (True, False), "sparse+chunked": (True, True)}
+
+
+class Partitioned:
+    """Within the context, `module.weight` is an empty placeholder except while the module runs its forward."""
+
+    def __init__(self, module):
+        self.module = module
+        self.full = module.weight.data
+        self.placeholder = self.full.new_empty(0)
+        self.active = False
+        module.register_forward_pre_hook(lambda module, inputs: self.swap(self.full))
+        module.register_forward_hook(lambda module, inputs, output: self.swap(self.placeholder))
+
+    def swap(self, data):
+        if self.active:
+            self.module.weight.data = data
+
+    def __enter__(self):
+        self.active = True
+        self.module.weight.data = self.placeholder
+
+    def __exit__(self, *exc):
+        self.active = False
+        self.module.weight.data = self.full
+
+
+def step(model, input_ids, labels, target, gt_score, sparse_logits, chunk_size, partitioned=None):
+    model.config.sparse_logits = sparse_logits
+    model.config.loss_chunk_size = chunk_size
+    model.zero_grad(set_to_none=True)
+    # only the forward is partitioned: ZeRO-3 gathers the weight again for backward (and for the chunks that
+    # checkpointing recomputes there)
+    with partitioned or contextlib.nullcontext():
+        loss = model(input_ids=input_ids, labels=labels, target=target, gt_score=gt_score, use_cache=False,
+                     return_dict=True).loss
+    loss.backward()
+    return float(loss), model.lm_head.weight.grad.clone()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--seq-len", type=int, default=64)
+    parser.add_argument("--chunk-size", type=int, default=16)
+    args = parser.parse_args()
+
+    reference, model = tiny_model(), tiny_model()
+    for m in (reference, model):
+        m.train()
+    config = model.config
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, config.score_id, (args.batch_size, args.seq_len))
+    # the prompt half of every row is not supervised, and every row is scored once
+    labels = input_ids.masked_fill(torch.arange(args.seq_len) < args.seq_len // 2, IGNORE_INDEX)
+    labels[:, -1] = input_ids[:, -1] = config.score_id
+    target = torch.softmax(torch.randn(args.batch_size, config.img_token_num), dim=1)
+    gt_score = torch.rand(args.batch_size, 1) * 9 + 1
+
+    partitioned = Partitioned(model.lm_head)
+    for name, (sparse_logits, chunked) in VARIANTS.items():
+        chunk_size = args.chunk_size if chunked else 0
+        reference_loss, reference_grad = step(reference, input_ids, labels, target, gt_score, sparse_logits,
+                                              chunk_size)
+        loss, grad = step(model, input_ids, labels, target, gt_score, sparse_logits, chunk_size, partitioned)
+        grad_diff = float((grad - reference_grad).abs().max())
+        print(f"{name:15s} loss {loss:.6f} (reference {reference_loss:.6f})  max |lm_head grad diff| {grad_diff:.1e}")
+        assert abs(loss - reference_loss) < 1e-5 * abs(reference_loss), f"{name} changed the loss"
+        assert grad_diff < 1e-5, f"{name} changed the lm_head gradient"
+
+    prompt = torch.randint(3, config.score_id, (args.batch_size, 16))
+    prompt[:, 1] = IMAGE_TOKEN_INDEX
+    images = torch.randn(args.batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+    with torch.inference_mode(), partitioned:
+        reference_logits = reference.score_logits(prompt, images=images)
+        score_logits = model.score_logits(prompt, images=images)
+    assert torch.allclose(score_logits, reference_logits, atol=1e-5), "score_logits changed"
+    print(f"score_logits    max |diff| {float((score_logits - reference_logits).abs().max()):.1e}")
+
+
+if __name__ == "__main__":
+    main()
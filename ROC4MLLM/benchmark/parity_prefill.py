@@ -0,0 +1,69 @@
+"""Parity report: single-forward "prefill" scores against generate-based "score" mode scores.
+
+With --model_path and --input_dir the report runs on a real checkpoint and an image folder. Without them it runs
+on a tiny random model whose greedy answer is forced to the prefill prefix, which checks the mechanism itself.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from mplug_owl2.assessor import Assessment
+from benchmark.common import tiny_model, ByteTokenizer, tiny_image_processor, ForceAnswer
+
+
+def rank(x):
+    return np.argsort(np.argsort(x))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-m", "--model_path", type=str, default=None)
+    parser.add_argument("-i", "--input_dir", type=str, default=None)
+    parser.add_argument("-b", "--batch-size", type=int, default=8)
+    parser.add_argument("-n", "--num-images", type=int, default=64)
+    args = parser.parse_args()
+
+    if args.model_path:
+        assessment = Assessment(pretrained=args.model_path)
+        paths = sorted(os.path.join(root, f) for root, _, files in os.walk(args.input_dir) for f in files
+                       if f.lower().endswith(('.jpg', '.jpeg', '.png')))[:args.num_images]
+        load = lambda p: Image.open(p).convert('RGB')
+    else:
+        model = tiny_model()
+        assessment = Assessment(model=model, tokenizer=ByteTokenizer(model.config),
+                                image_processor=tiny_image_processor())
+        ForceAnswer(model, assessment.prefill_ids[0, assessment.input_ids.shape[1]:].tolist())
+        rng = np.random.default_rng(0)
+        paths = [rng.integers(0, 255, (48 + i % 5 * 8, 64, 3), dtype=np.uint8) for i in range(args.num_images)]
+        load = Image.fromarray
+
+    generated, prefilled, timings = [], [], {"score": 0.0, "prefill": 0.0}
+    for start in range(0, len(paths), args.batch_size):
+        images = [load(p) for p in paths[start:start + args.batch_size]]
+        for mode, out in (("score", generated), ("prefill", prefilled)):
+            begin = time.perf_counter()
+            out.extend(assessment(images, precision=6, mode=mode)[1])
+            timings[mode] += time.perf_counter() - begin
+
+    generated, prefilled = np.array(generated, dtype=float), np.array(prefilled, dtype=float)
+    scored = generated != -1
+    diff = np.abs(generated[scored] - prefilled[scored])
+    print(f"images:                    {len(paths)}")
+    print(f"[SCORE] emitted (generate): {scored.sum()} / {len(paths)}")
+    if scored.any():
+        print(f"mean |generate - prefill|:  {diff.mean():.6f}")
+        print(f"max  |generate - prefill|:  {diff.max():.6f}")
+    if scored.sum() > 2:
+        print(f"PLCC:                      {np.corrcoef(generated[scored], prefilled[scored])[0, 1]:.6f}")
+        print(f"SRCC:                      "
+              f"{np.corrcoef(rank(generated[scored]), rank(prefilled[scored]))[0, 1]:.6f}")
+    print(f"time score mode:           {timings['score']:.2f} s")
+    print(f"time prefill mode:         {timings['prefill']:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Parity and speed of the ViT attention backends: "sdpa" against the eager softmax(QK^T) path.
+
+Without --model_path it runs a randomly initialised vision tower with the released geometry (448px, 14px patches,
+1025 tokens, hidden 1024, 16 heads) and --layers layers; with it, the vision tower of the checkpoint:
+
+    python -m benchmark.parity_vit_attention --batch-size 4 --layers 2
+    python -m benchmark.parity_vit_attention -m models --batch-size 16
+"""
+import argparse
+
+import torch
+
+from mplug_owl2.model.configuration_mplug_owl2 import MplugOwlVisionConfig
+from mplug_owl2.model.visual_encoder import MplugOwlVisionModel
+from benchmark.common import timeit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-m", "--model_path", type=str, default=None)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.model_path:
+        from mplug_owl2.model.builder import load_pretrained_model
+        _, model, _, _ = load_pretrained_model(args.model_path, None, "mplug_owl2", device=args.device)
+        vision_model = model.get_model().vision_model
+    else:
+        torch.manual_seed(0)
+        vision_model = MplugOwlVisionModel(MplugOwlVisionConfig(num_hidden_layers=args.layers)).to(device)
+        if device.type == "cuda":
+            vision_model.half()
+    vision_model.eval()
+    # every attention layer reads the backend from this config object
+    config = vision_model.config
+    size = config.image_size
+    torch.manual_seed(1)
+    pixel_values = torch.randn(args.batch_size, 3, size, size, device=device, dtype=vision_model.dtype)
+
+    def encode():
+        with torch.inference_mode():
+            return vision_model(pixel_values).last_hidden_state
+
+    results = {}
+    for backend in ("eager", "sdpa"):
+        config.attention_backend = backend
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        output = encode()
+        seconds = timeit(encode, repeat=args.repeat)
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else float("nan")
+        results[backend] = (output.float(), seconds, peak)
+
+    eager, eager_seconds, _ = results["eager"]
+    sdpa, sdpa_seconds, _ = results["sdpa"]
+    max_diff = float((sdpa - eager).abs().max())
+    relative = max_diff / float(eager.abs().max())
+    print(f"batch={args.batch_size} tokens={eager.shape[1]} layers={config.num_hidden_layers} "
+          f"dtype={vision_model.dtype} device={device}")
+    for backend, (_, seconds, peak) in results.items():
+        memory = f"  peak {peak:8.1f} MB" if device.type == "cuda" else ""
+        print(f"{backend:6s} {1000 * seconds:8.1f} ms/batch{memory}  ({eager_seconds / seconds:.2f}x)")
+    print(f"max |sdpa - eager| = {max_diff:.2e} ({relative:.1e} of max |eager|)")
+    tolerance = 1e-2 if vision_model.dtype == torch.float16 else 1e-4
+    assert relative < tolerance, f"sdpa differs from eager by {relative:.1e} (tolerance {tolerance:.0e})"
+
+
+if __name__ == "__main__":
+    main()
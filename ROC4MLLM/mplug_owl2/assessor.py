@@ -1,13 +1,146 @@
+import copy
 import torch.nn as nn
 from PIL import Image
 from mplug_owl2.model.builder import load_pretrained_model
 import torch
+from transformers import LogitsProcessorList
+from transformers.generation.utils import GreedySearchDecoderOnlyOutput
 from mplug_owl2.conversation import conv_templates
-from mplug_owl2.mm_utils import tokenizer_image_token
+from mplug_owl2.mm_utils import tokenizer_image_token, expand2square, BatchStoppingCriteria
+from mplug_owl2.model.kv_cache import StaticKVCache
 from typing import List
-import numpy as np
+
+SCORE_PREFIX = "The aesthetic rate of the image is"
+
+
+def build_prefill_ids(prompt, tokenizer, score_id, answer_prefix=SCORE_PREFIX):
+    # Tokenize the answer together with [SCORE] so it is split exactly like the training answers, then drop
+    # [SCORE] itself: the score distribution is read from the position that predicts it.
+    input_ids = tokenizer_image_token(prompt + " " + answer_prefix + " [SCORE]", tokenizer, -200, return_tensors='pt')
+    score_index = (input_ids == score_id).nonzero()
+    if not len(score_index):
+        raise ValueError("[SCORE] is not a single token of the tokenizer, the checkpoint has no score tokens")
+    return input_ids[:score_index[-1, 0]]
+
+
+def batch_input_ids(model, input_ids, batch_size, key):
+    # repeated prompt ids are cached on the model, `key` is the tuple of prompt ids built once by the caller; keyed
+    # by the model's device, like the score weights, so a model moved with .to() gets ids on its new device
+    device = model.device
+    return model.derived_constants.get(("input_ids", key, batch_size, device),
+                                       lambda: input_ids.to(device).repeat(batch_size, 1))
+
+
+def prefix_cache(model, prefix_ids, key):
+    # KV cache of the prompt text before the image, which is the same for every request; it is computed once
+    # with batch size 1 and broadcast over the batch by the model. Cached on the model and keyed by its device,
+    # like the repeated prompt ids, so a model moved with .to() gets a cache on its new device.
+    device = model.device
+
+    def build():
+        with torch.inference_mode():
+            return model(input_ids=prefix_ids.to(device), use_cache=True, return_dict=True).past_key_values
+
+    return model.derived_constants.get(("prefix_key_values", key, device), build)
+
+
+def prefill_score_logits(model, input_ids, image_tensors, key, prefix_key_values=None, image_features=None):
+    # one forward over prompt + answer prefix, no autoregressive loop; precomputed `image_features` replace
+    # `image_tensors` when given
+    batch_size = len(image_tensors if image_features is None else image_features)
+    return model.score_logits(
+        batch_input_ids(model, input_ids, batch_size, key),
+        images=image_tensors,
+        image_features=image_features,
+        past_key_values=prefix_key_values,
+    )
+
+
+def expected_score(score_logits, weights):
+    # softmax over the [IMG*] logits, weighted by the score of each bin: [batch, num_tokens] -> [batch]
+    return torch.softmax(score_logits.float(), dim=-1) @ weights
+
+
+def select_rows(past_key_values, rows):
+    # the KV cache of the batch rows `rows`
+    if isinstance(past_key_values, StaticKVCache):
+        return past_key_values.select(rows)
+    return tuple(tuple(state[rows] for state in layer_past) for layer_past in past_key_values)
+
+
+def greedy_generate(model, input_ids, max_new_tokens, stopping_criteria, pad_token_id, **model_kwargs):
+    # Greedy decoding like model.generate(do_sample=False, return_dict_in_generate=True, output_scores=True), but
+    # the rows that `stopping_criteria` (a BatchStoppingCriteria) marks as finished leave the batch: the next
+    # steps only run the active rows and the finished ones are padded with `pad_token_id`. `model_kwargs` are
+    # passed to prepare_inputs_for_generation (images, prefix_key_values, static_cache_length, ...).
+    generation_config = copy.deepcopy(model.generation_config)
+    generation_config.update(do_sample=False, max_new_tokens=max_new_tokens)
+    logits_processor = model._get_logits_processor(generation_config, input_ids.shape[1], input_ids, None,
+                                                   LogitsProcessorList())
+    batch_size = input_ids.shape[0]
+    active = torch.arange(batch_size, device=input_ids.device)
+    ids = input_ids
+    sequences = [input_ids]
+    scores = []
+    past_key_values = None
+    for _ in range(max_new_tokens):
+        inputs = model.prepare_inputs_for_generation(
+            ids, past_key_values=past_key_values, attention_mask=torch.ones_like(ids), use_cache=True,
+            **model_kwargs)
+        outputs = model(**inputs, return_dict=True)
+        next_scores = logits_processor(ids, outputs.logits[:, -1, :])
+        next_tokens = next_scores.argmax(dim=-1)
+        step_scores = next_scores.new_zeros(batch_size, next_scores.shape[-1])
+        step_scores[active] = next_scores
+        scores.append(step_scores)
+        step_tokens = next_tokens.new_full((batch_size,), pad_token_id)
+        step_tokens[active] = next_tokens
+        sequences.append(step_tokens[:, None])
+
+        ids = torch.cat([ids, next_tokens[:, None]], dim=-1)
+        past_key_values = outputs.past_key_values
+        finished = stopping_criteria.update(ids)
+        if finished.all():
+            break
+        if finished.any():
+            keep = (~finished).nonzero()[:, 0]
+            active, ids = active[keep], ids[keep]
+            past_key_values = select_rows(past_key_values, keep)
+            model_kwargs = {
+                key: value[keep] if torch.is_tensor(value) else value
+                for key, value in model_kwargs.items()
+            }
+    return GreedySearchDecoderOnlyOutput(sequences=torch.cat(sequences, dim=-1), scores=tuple(scores))
+
+
+def extract_generated_scores(outputs, prompt_len, score_id, img_token_num):
+    # First [SCORE] position of every row in one pass. Only the [IMG*] slice of each step is stacked,
+    # which keeps this at [batch, steps, img_token_num] instead of the full vocabulary.
+    is_score = outputs.sequences[:, prompt_len:] == score_id
+    has_score = is_score.any(dim=1)
+    index = is_score.int().argmax(dim=1)
+    img_logits = torch.stack([step[:, -img_token_num:] for step in outputs.scores], dim=1)
+    score_logits = img_logits[torch.arange(len(index), device=index.device), index]
+    return score_logits, index, has_score
+
+
+def preprocess_images(images, image_processor, background_color):
+    # pad to a square with the mean colour, then resize and normalize: [batch, 3, H, W] float tensor on the CPU.
+    # Kept separate from Assessment so data loader workers can run it without the model.
+    images = [expand2square(img, background_color) for img in images]
+    return image_processor.preprocess(images, return_tensors='pt')['pixel_values']
+
+
 class Assessment(nn.Module):
-    def __init__(self, pretrained="", device="cuda:0",model=None,tokenizer=None,image_processor=None):
+    # "comment" decodes the full critique, "score" stops every row as soon as it has emitted [SCORE],
+    # "prefill" appends the answer prefix to the prompt and scores in a single forward pass
+    MODES = ("comment", "score", "prefill")
+    # batch sizes whose repeated prompt ids are built at load time
+    COMMON_BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+
+    def __init__(self, pretrained="", device="cuda:0",model=None,tokenizer=None,image_processor=None,
+                 max_score_steps=64, use_prefix_cache=True, tensor_store=None, feature_store=None,
+                 use_static_cache=True):
         super().__init__()
         if model is None:
             tokenizer, model, image_processor, _ = load_pretrained_model(pretrained, None, "mplug_owl2", device=device)
@@ -21,69 +154,131 @@ class Assessment(nn.Module):
         prompt = conv.get_prompt()
         self.input_ids = tokenizer_image_token(prompt, tokenizer, -200, return_tensors='pt').unsqueeze(0).to(
             model.device)
+        self.prefill_ids = build_prefill_ids(prompt, tokenizer, model.config.score_id).unsqueeze(0).to(model.device)
+        self.prefix_ids = None
+        prefix_len = 0
+        if use_prefix_cache:
+            # only the image and the text after it are prefilled per request
+            prefix_len = int((self.input_ids[0] == -200).nonzero()[0, 0])
+            self.prefix_ids = self.input_ids[:, :prefix_len]
+            self.input_ids = self.input_ids[:, prefix_len:]
+            self.prefill_ids = self.prefill_ids[:, prefix_len:]
+        self.prompt = prompt
         self.tokenizer = tokenizer
         self.model = model
         self.image_processor = image_processor
+        self.max_score_steps = max_score_steps
+        # optional mplug_owl2.tensor_store.TensorStore that image paths passed to forward are read from
+        self.tensor_store = tensor_store
+        # optional mplug_owl2.tensor_store.VisionFeatureStore, takes precedence over tensor_store for paths
+        self.feature_store = feature_store
+        self.background_color = tuple(int(x*255) for x in image_processor.image_mean)
+        # identify the prompts in the model's derived constants, e.g. when several assessors share one model
+        self.prompt_key = tuple(self.input_ids[0].tolist())
+        self.prefill_key = tuple(self.prefill_ids[0].tolist())
+        self.prefix_key = None if self.prefix_ids is None else tuple(self.prefix_ids[0].tolist())
+        # prompt length once the image is expanded to its visual tokens, for sizing the static KV cache
+        self.prompt_cache_length = None
+        if use_static_cache:
+            num_image_tokens = model.get_model().visual_abstractor.query_embeds.shape[1] + 1
+            self.prompt_cache_length = prefix_len + self.input_ids.shape[1] - 1 + num_image_tokens
+        self.prefix_key_values()
+        for batch_size in self.COMMON_BATCH_SIZES:
+            batch_input_ids(model, self.input_ids, batch_size, self.prompt_key)
+            batch_input_ids(model, self.prefill_ids, batch_size, self.prefill_key)
+
+    def prefix_key_values(self):
+        # the prompt-prefix KV cache on the model's current device, None without use_prefix_cache
+        if self.prefix_ids is None:
+            return None
+        return prefix_cache(self.model, self.prefix_ids, self.prefix_key)
+
+    def static_cache_length(self, max_new_tokens):
+        # capacity of the preallocated KV cache of a generation, None to grow the cache by concatenation
+        if self.prompt_cache_length is None:
+            return None
+        return self.prompt_cache_length + max_new_tokens
 
-    def expand2square(self,pil_img, background_color):
-        width, height = pil_img.size
-        if width == height:
-            return pil_img
-        elif width > height:
-            result = Image.new(pil_img.mode, (width, width), background_color)
-            result.paste(pil_img, (0, (width - height) // 2))
-            return result
-        else:
-            result = Image.new(pil_img.mode, (height, height), background_color)
-            result.paste(pil_img, ((height - width) // 2, 0))
-            return result
-
-    def forward(self,image, precision):
+    def generate(self, image_tensors, image_features=None, max_new_tokens=512, stop_at_score=False):
+        # Greedy decoding of the assessment; finished rows leave the batch. With `stop_at_score`, [SCORE]
+        # finishes a row like eos, so the comment after the score is never decoded.
+        eos_token_id = self.model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        if not isinstance(eos_token_id, list):
+            eos_token_id = [eos_token_id]
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = eos_token_id[0]
+        stop_token_ids = eos_token_id + [self.model.config.score_id] if stop_at_score else eos_token_id
+        batch_size = len(image_tensors if image_features is None else image_features)
+        input_ids = batch_input_ids(self.model, self.input_ids, batch_size, self.prompt_key)
+        return greedy_generate(
+            self.model,
+            input_ids,
+            max_new_tokens,
+            BatchStoppingCriteria(input_ids.shape[1], stop_token_ids),
+            pad_token_id,
+            images=image_tensors,
+            image_features=image_features,
+            prefix_key_values=self.prefix_key_values(),
+            static_cache_length=self.static_cache_length(max_new_tokens),
+        )
+
+    def generate_score(self, image_tensors, image_features=None):
+        return self.generate(image_tensors, image_features, self.max_score_steps, stop_at_score=True)
+
+    def forward(self,image, precision=4, mode="comment"):
+        # `image` is a list of PIL images or image paths, or a tensor already returned by preprocess_images
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown assessment mode: {mode}, expected one of {self.MODES}")
         # image=[image]
-        image =  [self.expand2square(img, tuple(int(x*255) for x in self.image_processor.image_mean)) for img in image]
+        image_features = None
+        if self.feature_store is not None and not torch.is_tensor(image) and all(
+                isinstance(img, str) for img in image):
+            image_features = self.feature_store.load(image)
+            image = None
+        elif not torch.is_tensor(image):
+            if self.tensor_store is not None and all(isinstance(img, str) for img in image):
+                image = torch.stack([self.tensor_store.load(path) for path in image])
+            else:
+                image = [Image.open(img).convert('RGB') if isinstance(img, str) else img for img in image]
+                image = preprocess_images(image, self.image_processor, self.background_color)
         with torch.inference_mode():
-            image_tensors = self.image_processor.preprocess(image, return_tensors='pt')['pixel_values'].half().to(self.model.device)
+            if image_features is None:
+                image_tensors = image.to(self.model.device, dtype=self.model.get_model().vision_model.dtype,
+                                         non_blocking=True)
+            else:
+                image_tensors = None
+                image_features = image_features.to(self.model.device, non_blocking=True)
             # print(image_tensors.shape)
             # print(torch.cat(image_tensors, 0).shape)
-            outputs = self.model.generate(
-                self.input_ids.repeat(len(image_tensors), 1),
-                images=image_tensors,
-                do_sample=False,
-                max_new_tokens=512,
-                use_cache=True,
-                output_hidden_states=True,
-                return_dict_in_generate=True,
-                output_scores=True,
-            )
+            if mode == "prefill":
+                scores = expected_score(
+                    prefill_score_logits(self.model, self.prefill_ids, image_tensors, self.prefill_key,
+                                         self.prefix_key_values(), image_features),
+                    self.model.get_score_weights())
+                output_score = [round(score, precision) for score in scores.tolist()]
+                return [f"{SCORE_PREFIX} {score}." for score in output_score], output_score
+            if mode == "score":
+                outputs = self.generate_score(image_tensors, image_features)
+            else:
+                outputs = self.generate(image_tensors, image_features)
+            prompt_len = self.input_ids.shape[1]
+            score_logits, index, has_score = extract_generated_scores(
+                outputs, prompt_len, self.model.config.score_id, self.model.config.img_token_num)
+            scores = expected_score(score_logits, self.model.get_score_weights())
+            output_ids = outputs.sequences[:, prompt_len:].tolist()
             output_text=[]
             output_score=[]
-            logits = outputs.scores
-            # print(len(image_tensors))
-            for i in range(len(image_tensors)):
-                output_ids = outputs.sequences[i]
-                # special_token_index = (
-                #         (output_ids >= self.model.config.output_first_id) & (
-                #         output_ids <= self.model.config.output_last_id)).nonzero()
-                special_token_index = (output_ids == self.model.config.score_id ).nonzero()
-                if len(special_token_index):
-                    index = special_token_index[0, 0]
-                    input_embedding = logits[index - self.input_ids.shape[1]][i, -self.model.config.img_token_num:].view(1, -1)
-                    score = torch.softmax(input_embedding, dim=1)
-                    w = torch.from_numpy(
-                        np.linspace(self.model.config.min_score, self.model.config.max_score, self.model.config.num_tokens)).to(
-                        score.device)
-                    w = w.type(torch.FloatTensor)
-                    w_batch = w.repeat(score.size(0), 1).to(score.device)
-
-                    score = (score * w_batch).sum(dim=1)
-                    text1 = self.tokenizer.decode(output_ids[self.input_ids.shape[1]:index], skip_special_tokens=True)
-                    text2 = self.tokenizer.decode(output_ids[index + 1:], skip_special_tokens=True)
-                    pred_text = text1 + f" {round(float(score),precision)} " + text2
-                    output_text.append(pred_text)
-                    output_score.append(round(float(score),precision))
-
+            for ids, idx, scored, score in zip(output_ids, index.tolist(), has_score.tolist(), scores.tolist()):
+                if scored:
+                    score = round(score, precision)
+                    text1 = self.tokenizer.decode(ids[:idx], skip_special_tokens=True)
+                    text2 = self.tokenizer.decode(ids[idx + 1:], skip_special_tokens=True)
+                    output_text.append(text1 + f" {score} " + text2)
+                    output_score.append(score)
                 else:
-                    pred_text = self.tokenizer.decode(output_ids[self.input_ids.shape[1]:], skip_special_tokens=True).strip()
-                    output_text.append(pred_text)
+                    output_text.append(self.tokenizer.decode(ids, skip_special_tokens=True).strip())
                     output_score.append(-1)
         return output_text,output_score
@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    # Collects concurrent requests into batches and runs `batch_fn` on a single worker thread. A batch is
+    # started once it holds `max_batch_size` items or `max_wait_ms` after its first item was submitted.
+    # `batch_fn` takes a list of items and returns one result per item, in order.
+
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=10, name="batch-scheduler"):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be >= 1, got {max_batch_size}")
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        # returns a concurrent.futures.Future, use asyncio.wrap_future() to await it from a handler
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is closed")
+            self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def close(self, timeout=None):
+        with self._lock:
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join(timeout)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # finish the current batch first, then stop
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # requests cancelled while waiting are dropped from the batch
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = time.perf_counter()
+            waits = [start - submitted for _, _, submitted in batch]
+            try:
+                results = self.batch_fn([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"batch_fn returned {len(results)} results for {len(batch)} items")
+            except Exception as e:
+                results = None
+                error = e
+            end = time.perf_counter()
+            with self._lock:
+                self.batch_sizes[len(batch)] += 1
+                self.num_requests += len(batch)
+                self.wait_time += sum(waits)
+                self.max_wait_time = max(self.max_wait_time, max(waits))
+                self.run_time += end - start
+                if results is None:
+                    self.num_errors += len(batch)
+            for i, (_, future, _) in enumerate(batch):
+                if results is None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(results[i])
+
+    def metrics(self):
+        with self._lock:
+            num_batches = sum(self.batch_sizes.values())
+            return {
+                "queue_depth": self._queue.qsize(),
+                "requests": self.num_requests,
+                "errors": self.num_errors,
+                "batches": num_batches,
+                "mean_batch_size": self.num_requests / num_batches if num_batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                # time from submit until the batch holding the request starts running
+                "mean_time_to_batch_ms": 1000 * self.wait_time / self.num_requests if self.num_requests else 0.0,
+                "max_time_to_batch_ms": 1000 * self.max_wait_time,
+                "mean_batch_time_ms": 1000 * self.run_time / num_batches if num_batches else 0.0,
+            }
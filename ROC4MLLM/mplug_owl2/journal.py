@@ -0,0 +1,69 @@
+import json
+import os
+
+
+class ResultsJournal:
+    # Append-only JSONL log of scored images, keyed by relative path, file size and mtime. Every batch is
+    # flushed and fsynced as soon as it is scored, so an interrupted run loses at most the batch in flight,
+    # and a rerun only scores files that are new, changed or failed last time. The last line of a path wins.
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        num_lines = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # torn last line of a run that was killed mid-write
+                        continue
+                    self.records[record["file_path"]] = record
+                    num_lines += 1
+        if num_lines > 2 * len(self.records):
+            self.compact()
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # terminate a torn line so the next record starts on its own line
+                    self._file.write("\n")
+
+    def is_scored(self, rel_path, size, mtime_ns):
+        record = self.records.get(rel_path)
+        return (record is not None and record["score"] is not None
+                and record["size"] == size and record["mtime_ns"] == mtime_ns)
+
+    def append(self, records):
+        for record in records:
+            self.records[record["file_path"]] = record
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def clear(self):
+        self.records = {}
+        self._file.truncate(0)
+
+    def compact(self):
+        # rewrite the journal with one line per path
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def write_results(self, rel_paths, output_path):
+        # results.json in the format read by classify_images.py and app_viewer.py, for the given files only
+        results = [{key: self.records[rel_path][key] for key in ("file_path", "score", "comment")}
+                   for rel_path in rel_paths if rel_path in self.records]
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, output_path)
+        return results
+
+    def close(self):
+        self._file.close()
@@ -12,6 +12,15 @@ def load_image_from_base64(image):
     return Image.open(BytesIO(base64.b64decode(image)))
 
 
+def load_image_from_bytes(data, max_pixels=None):
+    # decode an uploaded image in memory; the size is read from the header, so oversized images are
+    # rejected before their pixels are decoded
+    image = Image.open(BytesIO(data))
+    if max_pixels is not None and image.width * image.height > max_pixels:
+        raise ValueError(f"image is {image.width}x{image.height}, larger than {max_pixels} pixels")
+    return image.convert('RGB')
+
+
 def expand2square(pil_img, background_color):
     width, height = pil_img.size
     if width == height:
@@ -109,4 +118,40 @@ class KeywordsStoppingCriteria(StoppingCriteria):
         for keyword in self.keywords:
             if keyword in outputs:
                 return True
-        return False
\ No newline at end of file
+        return False
+
+
+class BatchStoppingCriteria(StoppingCriteria):
+    # Per-row completion from token ids alone, without decoding: a row is finished once its last token is one
+    # of `stop_token_ids` (eos, or [SCORE] when only the score is needed) or it ends with the token ids of one of
+    # `keywords`. `update` returns the rows finished by the last step; as a generate() stopping criterion it stops
+    # when every row has finished.
+    def __init__(self, start_len, stop_token_ids=(), keywords=(), tokenizer=None):
+        self.start_len = start_len
+        self.stop_token_ids = torch.tensor(list(stop_token_ids), dtype=torch.long)
+        self.keyword_ids = []
+        for keyword in keywords:
+            cur_keyword_ids = tokenizer(keyword).input_ids
+            if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
+                cur_keyword_ids = cur_keyword_ids[1:]
+            self.keyword_ids.append(torch.tensor(cur_keyword_ids, dtype=torch.long))
+        self.finished = None
+
+    def update(self, output_ids: torch.LongTensor) -> torch.BoolTensor:
+        if self.stop_token_ids.device != output_ids.device:
+            self.stop_token_ids = self.stop_token_ids.to(output_ids.device)
+            self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
+        done = torch.isin(output_ids[:, -1], self.stop_token_ids)
+        num_generated = output_ids.shape[1] - self.start_len
+        for keyword_id in self.keyword_ids:
+            if len(keyword_id) <= num_generated:
+                done |= (output_ids[:, -len(keyword_id):] == keyword_id).all(dim=1)
+        return done
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        done = self.update(output_ids)
+        if self.finished is None or output_ids.shape[1] == self.start_len + 1:
+            self.finished = done
+        else:
+            self.finished |= done
+        return bool(self.finished.all())
@@ -79,6 +79,12 @@ class LlamaConfig(PretrainedConfig):
             experimental feature, subject to breaking API changes in future versions.
         attention_bias (`bool`, defaults to `False`, *optional*, defaults to `False`):
             Whether to use a bias in the query, key, value and output projection layers during self-attention.
+        attention_backend (`str`, *optional*, defaults to `"eager"`):
+            How the language model computes attention: `"eager"` materialises the attention weights, `"sdpa"` calls
+            `torch.nn.functional.scaled_dot_product_attention` and `"chunked"` runs the eager computation over blocks
+            of `attention_chunk_size` queries to bound the size of the attention weights.
+        attention_chunk_size (`int`, *optional*, defaults to 128):
+            Number of queries per block of the `"chunked"` attention backend.
 
 
     ```python
@@ -117,6 +123,8 @@ class LlamaConfig(PretrainedConfig):
         rope_theta=10000.0,
         rope_scaling=None,
         attention_bias=False,
+        attention_backend="eager",
+        attention_chunk_size=128,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -140,6 +148,10 @@ class LlamaConfig(PretrainedConfig):
         self.rope_scaling = rope_scaling
         self._rope_scaling_validation()
         self.attention_bias = attention_bias
+        if attention_backend not in ("eager", "sdpa", "chunked"):
+            raise ValueError(f"`attention_backend` must be one of ['eager', 'sdpa', 'chunked'], got {attention_backend}")
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
 
         super().__init__(
             pad_token_id=pad_token_id,
@@ -207,6 +219,9 @@ class MplugOwlVisionConfig(PretrainedConfig):
          initializer_factor (`float`, *optional*, defaults to 1):
              A factor for initializing all weight matrices (should be kept to 1, used internally for initialization
              testing).
+         attention_backend (`str`, *optional*, defaults to `"eager"`):
+             `"eager"` computes softmax(QK^T) explicitly, `"sdpa"` calls
+             `torch.nn.functional.scaled_dot_product_attention` (flash or memory-efficient kernels where available).
 
 
      ```"""
@@ -229,6 +244,7 @@ class MplugOwlVisionConfig(PretrainedConfig):
         initializer_range=0.02,
         initializer_factor=1.0,
         use_flash_attn=False,
+        attention_backend="eager",
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -246,6 +262,9 @@ class MplugOwlVisionConfig(PretrainedConfig):
         self.layer_norm_eps = layer_norm_eps
         self.hidden_act = hidden_act
         self.use_flash_attn = use_flash_attn
+        if attention_backend not in ("eager", "sdpa"):
+            raise ValueError(f"`attention_backend` must be one of ['eager', 'sdpa'], got {attention_backend}")
+        self.attention_backend = attention_backend
 
     @classmethod
     def from_pretrained(cls, pretrained_model_name_or_path: Union[str, os.PathLike], **kwargs) -> "PretrainedConfig":
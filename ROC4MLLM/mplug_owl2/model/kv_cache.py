@@ -0,0 +1,74 @@
+import torch
+
+
+class StaticKVCache:
+    # Preallocated key/value buffers of every layer, [batch, kv_heads, capacity, head_dim], written in place at the
+    # current length instead of concatenating a new cache on every decoding step. `cache[i]` is the layer cache
+    # handed to LlamaAttention, and `cache[i][0]` / `cache[i][1]` are views of the keys / values written so far,
+    # as with the tuple cache, so code that reads `past_key_values[i][0].shape` works with both. A buffer doubles
+    # when a write would overflow it, so `capacity` only needs to be a good estimate of the final length.
+
+    def __init__(self, config, batch_size, capacity, dtype, device):
+        head_dim = config.hidden_size // config.num_attention_heads
+        shape = (batch_size, config.num_key_value_heads, capacity, head_dim)
+        self.keys = [torch.empty(shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        self.values = [torch.empty(shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        self.lengths = [0] * config.num_hidden_layers
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, idx):
+        return StaticLayerCache(self, idx % len(self.keys))
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+    def get_seq_length(self):
+        return self.lengths[0]
+
+    def update(self, idx, key_states, value_states):
+        # writes the new tokens of layer `idx` and returns the keys and values of all its tokens
+        start = self.lengths[idx]
+        end = start + key_states.shape[2]
+        if end > self.keys[idx].shape[2]:
+            self._grow(idx, end)
+        self.keys[idx][:, :, start:end] = key_states
+        self.values[idx][:, :, start:end] = value_states
+        self.lengths[idx] = end
+        return self.keys[idx][:, :, :end], self.values[idx][:, :, :end]
+
+    def _grow(self, idx, length):
+        capacity = max(length, 2 * self.keys[idx].shape[2])
+        for buffers in (self.keys, self.values):
+            old = buffers[idx]
+            buffers[idx] = old.new_empty(old.shape[:2] + (capacity,) + old.shape[3:])
+            buffers[idx][:, :, :self.lengths[idx]] = old[:, :, :self.lengths[idx]]
+
+    def select(self, rows):
+        # keeps the batch rows `rows` (a LongTensor), e.g. when finished sequences leave the batch
+        self.keys = [keys[rows] for keys in self.keys]
+        self.values = [values[rows] for values in self.values]
+        return self
+
+    def fill(self, past_key_values):
+        # copies a tuple cache, e.g. a batch-1 prompt prefix, broadcast over the batch
+        for idx, (key_states, value_states) in enumerate(past_key_values):
+            batch_shape = (self.keys[idx].shape[0],) + key_states.shape[1:]
+            self.update(idx, key_states.expand(batch_shape), value_states.expand(batch_shape))
+        return self
+
+
+class StaticLayerCache:
+    # the cache of one layer of a StaticKVCache
+
+    def __init__(self, cache, idx):
+        self.cache = cache
+        self.idx = idx
+
+    def __getitem__(self, i):
+        length = self.cache.lengths[self.idx]
+        return (self.cache.keys, self.cache.values)[i][self.idx][:, :, :length]
+
+    def update(self, key_states, value_states):
+        return self.cache.update(self.idx, key_states, value_states)
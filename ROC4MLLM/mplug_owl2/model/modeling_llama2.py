@@ -15,6 +15,27 @@ from transformers.utils import logging
 
 from .modeling_attn_mask_utils import _prepare_4d_causal_attention_mask
 from .configuration_mplug_owl2 import LlamaConfig
+from .kv_cache import StaticKVCache, StaticLayerCache
+
+class MultiwayLayout:
+    # How the tokens of a batch are split over the multiway branches, worked out once per forward and shared by
+    # every MultiwayNetwork of every layer. When all rows have the same modality pattern (the same prompt with
+    # one image, or text-only decoding steps) `segments` lists its contiguous (branch, start, end) runs along the
+    # sequence; otherwise it is None and the per-token indices are used.
+
+    def __init__(self, multiway_indices):
+        self.indices = multiway_indices
+        self.segments = None
+        if multiway_indices.dim() == 2 and (multiway_indices[1:] == multiway_indices[:1]).all():
+            row = multiway_indices[0].tolist()
+            segments = []
+            start = 0
+            for end in range(1, len(row) + 1):
+                if end == len(row) or row[end] != row[start]:
+                    segments.append((row[start], start, end))
+                    start = end
+            self.segments = segments
+
 
 class MultiwayNetwork(nn.Module):
 
@@ -28,6 +49,17 @@ class MultiwayNetwork(nn.Module):
         if len(self.multiway) == 1:
             return self.multiway[0](hidden_states)
 
+        if not isinstance(multiway_indices, MultiwayLayout):
+            multiway_indices = MultiwayLayout(multiway_indices)
+        segments = multiway_indices.segments
+        if segments is not None:
+            # contiguous spans shared by all rows: each branch runs on a slice, no gather or scatter
+            if len(segments) == 1:
+                return self.multiway[segments[0][0]](hidden_states)
+            outputs = [self.multiway[idx](hidden_states[:, start:end]) for idx, start, end in segments]
+            return torch.cat(outputs, dim=1)
+
+        multiway_indices = multiway_indices.indices
         output_hidden_states = torch.empty_like(hidden_states)
         
         for idx, subway in enumerate(self.multiway):
@@ -102,6 +134,15 @@ class LlamaAttention(nn.Module):
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
 
+    def _eager_attention(self, query_states, key_states, value_states, attention_mask):
+        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        if attention_mask is not None:
+            attn_weights = attn_weights + attention_mask
+
+        # upcast attention to fp32
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+        return torch.matmul(attn_weights, value_states), attn_weights
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -129,7 +170,10 @@ class LlamaAttention(nn.Module):
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, StaticLayerCache):
+            # preallocated cache: the new tokens are written in place
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
@@ -139,24 +183,31 @@ class LlamaAttention(nn.Module):
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
-
-        if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
+        if attention_mask is not None and attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
             raise ValueError(
-                f"Attention weights should be of size {(bsz, self.num_heads, q_len, kv_seq_len)}, but is"
-                f" {attn_weights.size()}"
+                f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
             )
 
-        if attention_mask is not None:
-            if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
-                raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
-                )
-            attn_weights = attn_weights + attention_mask
-
-        # upcast attention to fp32
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_output = torch.matmul(attn_weights, value_states)
+        backend = self.config.attention_backend
+        if backend == "sdpa" and not output_attentions:
+            # without padding model_forward passes no mask: sdpa applies causality itself and can use its fused
+            # kernels, which an explicit float mask rules out; a single decoded token attends to the whole cache
+            attn_output = F.scaled_dot_product_attention(
+                query_states, key_states, value_states, attn_mask=attention_mask,
+                is_causal=attention_mask is None and q_len == kv_seq_len,
+            )
+            attn_weights = None
+        elif backend == "chunked" and not output_attentions:
+            # eager attention over blocks of queries: the same result with at most chunk_size x kv_seq_len weights
+            chunk_size = self.config.attention_chunk_size
+            attn_output = torch.cat([
+                self._eager_attention(query_states[:, :, start:start + chunk_size], key_states, value_states,
+                                      None if attention_mask is None else attention_mask[:, :, start:start + chunk_size])[0]
+                for start in range(0, q_len, chunk_size)
+            ], dim=2)
+            attn_weights = None
+        else:
+            attn_output, attn_weights = self._eager_attention(query_states, key_states, value_states, attention_mask)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -247,6 +298,27 @@ class LlamaDecoderLayer(nn.Module):
         return outputs
 
 
+def packed_position_ids(segment_ids):
+    # positions restart from 0 at the first token of every sample of a packed row
+    positions = torch.arange(segment_ids.shape[1], device=segment_ids.device).expand_as(segment_ids)
+    is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+    is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    starts = torch.where(is_start, positions, torch.zeros_like(positions)).cummax(dim=1).values
+    return positions - starts
+
+
+def _prepare_packed_attention_mask(self, segment_ids, inputs_embeds):
+    # block-diagonal causal mask [bsz, 1, seq_len, seq_len] for packed rows: a token sees the earlier tokens of its
+    # own sample only; padding (segment 0) sees itself, which keeps its softmax finite
+    seq_len = segment_ids.shape[1]
+    device = segment_ids.device
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=device).tril()
+    allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0) & causal
+    allowed |= torch.eye(seq_len, dtype=torch.bool, device=device)
+    mask = torch.zeros(allowed.shape, dtype=inputs_embeds.dtype, device=device)
+    return mask.masked_fill(~allowed, torch.finfo(inputs_embeds.dtype).min)[:, None]
+
+
 def model_forward(
     self,
     input_ids: torch.LongTensor = None,
@@ -259,6 +331,7 @@ def model_forward(
     output_attentions: Optional[bool] = None,
     output_hidden_states: Optional[bool] = None,
     return_dict: Optional[bool] = None,
+    segment_ids: Optional[torch.LongTensor] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
     output_hidden_states = (
@@ -284,8 +357,15 @@ def model_forward(
     if past_key_values is not None:
         past_key_values_length = past_key_values[0][0].shape[2]
         seq_length_with_past = seq_length_with_past + past_key_values_length
+        if not isinstance(past_key_values, StaticKVCache) and past_key_values[0][0].shape[0] != batch_size:
+            # a prefix cache computed once with batch size 1 is broadcast over the batch without copying
+            past_key_values = tuple(
+                tuple(state.expand(batch_size, *state.shape[1:]) for state in layer_past) for layer_past in past_key_values
+            )
 
-    if position_ids is None:
+    if position_ids is None and segment_ids is not None:
+        position_ids = packed_position_ids(segment_ids)
+    elif position_ids is None:
         device = input_ids.device if input_ids is not None else inputs_embeds.device
         position_ids = torch.arange(
             past_key_values_length, seq_length + past_key_values_length, dtype=torch.long, device=device
@@ -297,18 +377,29 @@ def model_forward(
     if inputs_embeds is None:
         inputs_embeds = self.embed_tokens(input_ids)
     # embed positions
-    if attention_mask is None:
+    if segment_ids is not None:
+        # packed rows: the samples of a row attend only to themselves
+        attention_mask = self._prepare_packed_attention_mask(segment_ids, inputs_embeds)
+    elif attention_mask is None:
         attention_mask = torch.ones(
             (batch_size, seq_length_with_past), dtype=torch.bool, device=inputs_embeds.device
         )
-    if attention_mask is not None and attention_mask.dim() == 4:
+    if segment_ids is not None or attention_mask.dim() == 4:
         attention_mask=attention_mask
+    elif (
+        self.config.attention_backend == "sdpa" and not output_attentions
+        and (seq_length == seq_length_with_past or seq_length == 1) and bool(attention_mask.all())
+    ):
+        # no padding: sdpa is called with is_causal (or no mask for one decoded token) instead of a 4D float mask
+        attention_mask = None
     else:
         attention_mask = self._prepare_decoder_attention_mask(
             attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
         )
 
     hidden_states = inputs_embeds
+    if modality_indicators is not None:
+        modality_indicators = MultiwayLayout(modality_indicators)
 
     if self.gradient_checkpointing and self.training:
         if use_cache:
@@ -370,6 +461,9 @@ def model_forward(
         all_hidden_states += (hidden_states,)
 
     next_cache = next_decoder_cache if use_cache else None
+    if use_cache and isinstance(past_key_values, StaticKVCache):
+        # the layers wrote into the cache object, which is passed on to the next step
+        next_cache = past_key_values
     if not return_dict:
         return tuple(v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns] if v is not None)
     return BaseModelOutputWithPast(
@@ -479,6 +573,9 @@ def replace_llama_modality_adaptive():
     transformers.models.llama.modeling_llama.LlamaAttention = LlamaAttention
     transformers.models.llama.modeling_llama.LlamaDecoderLayer = LlamaDecoderLayer
     transformers.models.llama.modeling_llama.LlamaModel.forward = model_forward
+    if not hasattr(transformers.models.llama.modeling_llama.LlamaModel, "_prepare_packed_attention_mask"):
+        # the flash attention patch installs its own (cu_seqlens) version
+        transformers.models.llama.modeling_llama.LlamaModel._prepare_packed_attention_mask = _prepare_packed_attention_mask
     transformers.models.llama.modeling_llama.LlamaForCausalLM.forward = causal_model_forward
 
     
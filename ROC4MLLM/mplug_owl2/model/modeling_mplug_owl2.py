@@ -17,6 +17,7 @@ from typing import List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import CrossEntropyLoss
 
 from transformers import AutoConfig, AutoModelForCausalLM, LlamaConfig, LlamaModel, LlamaForCausalLM
@@ -25,9 +26,31 @@ from transformers.modeling_outputs import CausalLMOutputWithPast
 from .configuration_mplug_owl2 import MPLUGOwl2Config, MplugOwlVisionConfig, MplugOwlVisualAbstractorConfig
 from .visual_encoder import MplugOwlVisionModel, MplugOwlVisualAbstractorModel
 from .modeling_llama2 import replace_llama_modality_adaptive
+from .kv_cache import StaticKVCache
+from .utils import DerivedConstants
 from mplug_owl2.constants import IMAGE_TOKEN_INDEX, IGNORE_INDEX
 from icecream import ic
 
+
+def chunked_cross_entropy(inputs, labels, chunk_size, project=None):
+    # Mean cross-entropy of the next-token predictions `inputs` [batch, seq_len, ...] against `labels`
+    # [batch, seq_len] (IGNORE_INDEX skipped), `chunk_size` positions at a time. `project` maps a chunk of
+    # `inputs` to logits (e.g. lm_head on hidden states); without it `inputs` are the logits. With autograd on,
+    # every chunk is recomputed in backward, so only one chunk of logits and log-probabilities is alive at a time.
+    def chunk_loss(chunk, chunk_labels):
+        logits = project(chunk) if project is not None else chunk
+        return F.cross_entropy(logits.reshape(-1, logits.shape[-1]).float(), chunk_labels.reshape(-1),
+                               ignore_index=IGNORE_INDEX, reduction="sum")
+
+    total = 0
+    for start in range(0, inputs.shape[1], chunk_size):
+        chunk, chunk_labels = inputs[:, start:start + chunk_size], labels[:, start:start + chunk_size]
+        if torch.is_grad_enabled() and inputs.requires_grad:
+            total = total + torch.utils.checkpoint.checkpoint(chunk_loss, chunk, chunk_labels, use_reentrant=False)
+        else:
+            total = total + chunk_loss(chunk, chunk_labels)
+    return total / (labels != IGNORE_INDEX).sum()
+
 class MPLUGOwl2MetaModel:
     def __init__(self, config):
         super(MPLUGOwl2MetaModel, self).__init__(config)
@@ -62,15 +85,21 @@ class MPLUGOwl2MetaForCausalLM(ABC):
         return image_features
 
     def prepare_inputs_labels_for_multimodal(
-        self, input_ids, attention_mask, past_key_values, labels, images
+        self, input_ids, attention_mask, past_key_values, labels, images, image_features=None
     ):
+        # `image_features` are precomputed encode_images() outputs (e.g. from a VisionFeatureStore) used instead
+        # of `images`, so the vision model and the abstractor are skipped
+        if image_features is not None:
+            images = image_features
         if images is None or input_ids.shape[1] == 1:
             if past_key_values is not None and images is not None and input_ids.shape[1] == 1:
                 attention_mask = torch.ones((attention_mask.shape[0], past_key_values[-1][-1].shape[-2] + 1), dtype=attention_mask.dtype, device=attention_mask.device)
             multiway_indices = torch.zeros_like(input_ids).long().to(self.device)
             return input_ids, multiway_indices, attention_mask, past_key_values, None, labels
         
-        if type(images) is list or images.ndim == 5:
+        if image_features is not None:
+            image_features = image_features.to(dtype=self.get_model().embed_tokens.weight.dtype)
+        elif type(images) is list or images.ndim == 5:
             concat_images = torch.cat([image for image in images], dim=0)
             image_features = self.encode_images(concat_images)
             split_sizes = [image.shape[0] for image in images]
@@ -79,6 +108,12 @@ class MPLUGOwl2MetaForCausalLM(ABC):
         else:
             image_features = self.encode_images(images)
 
+        if torch.is_tensor(image_features) and len(image_features) == len(input_ids):
+            is_image_token = input_ids == IMAGE_TOKEN_INDEX
+            if bool((is_image_token.sum(dim=1) == 1).all()):
+                return self.prepare_single_image_inputs(
+                    input_ids, is_image_token, attention_mask, past_key_values, labels, image_features)
+
         new_input_embeds = []
         new_modality_indicators = []
         new_labels = [] if labels is not None else None
@@ -187,11 +222,94 @@ class MPLUGOwl2MetaForCausalLM(ABC):
                 new_labels = torch.stack(new_labels, dim=0)
 
             if attention_mask is not None:
-                new_attn_mask_pad_left = torch.full((attention_mask.shape[0], new_input_embeds.shape[1] - input_ids.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
+                # with a prefix cache (e.g. the shared system prompt) the mask also has to cover the cached tokens
+                past_length = past_key_values[0][0].shape[-2] if past_key_values is not None else 0
+                new_attn_mask_pad_left = torch.full((attention_mask.shape[0], past_length + new_input_embeds.shape[1] - attention_mask.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
                 attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
-                assert attention_mask.shape == new_input_embeds.shape[:2]
+                assert attention_mask.shape[1] == past_length + new_input_embeds.shape[1]
+        return None, new_modality_indicators, attention_mask, past_key_values, new_input_embeds, new_labels
+
+    def prepare_single_image_inputs(
+        self, input_ids, is_image_token, attention_mask, past_key_values, labels, image_features
+    ):
+        # Batched prepare_inputs_labels_for_multimodal for exactly one image token per row (at any position):
+        # every row grows by the same num_queries - 1 tokens, so there is no padding. The token ids are laid out
+        # around the image span with one gather, embedded in one lookup, and the image features are scattered
+        # into the span; the modality indicators are a comparison with the span.
+        batch_size, seq_len = input_ids.shape
+        num_image_tokens = image_features.shape[1]
+        new_len = seq_len - 1 + num_image_tokens
+        image_start = is_image_token.int().argmax(dim=1, keepdim=True)
+        positions = torch.arange(new_len, device=input_ids.device).unsqueeze(0)
+        is_image = (positions >= image_start) & (positions < image_start + num_image_tokens)
+
+        # position in input_ids of each new token (clamped inside the image span, which is overwritten)
+        text_index = torch.where(positions < image_start, positions, positions - num_image_tokens + 1)
+        text_index = text_index.clamp(0, seq_len - 1)
+        new_input_ids = input_ids.gather(1, text_index).masked_fill(is_image, 0)
+        new_input_embeds = self.get_model().embed_tokens(new_input_ids)
+        hidden_size = new_input_embeds.shape[-1]
+        image_rows = (image_start + torch.arange(batch_size, device=input_ids.device).unsqueeze(1) * new_len
+                      + torch.arange(num_image_tokens, device=input_ids.device).unsqueeze(0)).flatten()
+        new_input_embeds = new_input_embeds.view(-1, hidden_size).index_copy(
+            0, image_rows, image_features.reshape(-1, hidden_size).to(new_input_embeds.dtype)
+        ).view(batch_size, new_len, hidden_size)
+        new_modality_indicators = is_image.long()
+
+        new_labels = None
+        if labels is not None:
+            new_labels = labels.gather(1, text_index).masked_fill(is_image, IGNORE_INDEX)
+
+        if attention_mask is not None:
+            # same as the loop: the image tokens replacing the placeholder and the cached prefix are prepended
+            past_length = past_key_values[0][0].shape[-2] if past_key_values is not None else 0
+            new_attn_mask_pad_left = torch.full((batch_size, past_length + new_len - attention_mask.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
+            attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
         return None, new_modality_indicators, attention_mask, past_key_values, new_input_embeds, new_labels
 
+    def prepare_packed_inputs(self, input_ids, segment_ids, labels, images, image_features=None):
+        # Packed rows from PackedDataCollatorForSupervisedDataset: several samples per row, numbered by
+        # `segment_ids` (0 is padding), each with at most one image token; `images` / `image_features` hold the
+        # images in row-major order of their tokens. Every token moves right by num_queries - 1 per image token
+        # before it in its row, so the ids, labels and segment ids are scattered to their new positions in one
+        # pass and the image features are copied into their spans. Rows are padded to the longest result.
+        if image_features is None and images is not None:
+            image_features = self.encode_images(images)
+        batch_size, seq_len = input_ids.shape
+        device = input_ids.device
+        is_image_token = input_ids == IMAGE_TOKEN_INDEX
+        num_images = int(is_image_token.sum())
+        num_image_tokens = image_features.shape[1] if image_features is not None else 1
+        if num_images != (len(image_features) if image_features is not None else 0):
+            raise ValueError(f"{num_images} image tokens in the packed batch but "
+                             f"{0 if image_features is None else len(image_features)} images")
+
+        images_before = is_image_token.cumsum(dim=1) - is_image_token.long()
+        new_positions = torch.arange(seq_len, device=device) + (num_image_tokens - 1) * images_before
+        new_len = seq_len + (num_image_tokens - 1) * int(is_image_token.sum(dim=1).max())
+
+        def place(values, fill_value):
+            return values.new_full((batch_size, new_len), fill_value).scatter_(1, new_positions, values)
+
+        new_input_ids = place(input_ids.masked_fill(is_image_token, 0), 0)
+        new_segment_ids = place(segment_ids, 0)
+        new_labels = None
+        if labels is not None:
+            new_labels = place(labels.masked_fill(is_image_token, IGNORE_INDEX), IGNORE_INDEX)
+        new_input_embeds = self.get_model().embed_tokens(new_input_ids)
+        new_modality_indicators = torch.zeros_like(new_input_ids)
+        if num_images:
+            hidden_size = new_input_embeds.shape[-1]
+            rows, cols = is_image_token.nonzero(as_tuple=True)
+            image_rows = ((rows * new_len + new_positions[rows, cols]).unsqueeze(1)
+                          + torch.arange(num_image_tokens, device=device).unsqueeze(0)).flatten()
+            new_input_embeds = new_input_embeds.view(-1, hidden_size).index_copy(
+                0, image_rows, image_features.reshape(-1, hidden_size).to(new_input_embeds.dtype)
+            ).view(batch_size, new_len, hidden_size)
+            new_modality_indicators.view(-1)[image_rows] = 1
+            new_segment_ids.view(-1)[image_rows] = segment_ids[rows, cols].repeat_interleave(num_image_tokens)
+        return new_modality_indicators, new_segment_ids, new_input_embeds, new_labels
+
 
 class MPLUGOwl2LlamaModel(MPLUGOwl2MetaModel, LlamaModel):
     config_class = MPLUGOwl2Config
@@ -210,8 +328,7 @@ class MPLUGOwl2LlamaForCausalLM(LlamaForCausalLM, MPLUGOwl2MetaForCausalLM):
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
         # self.Loss = CustomMultiLoss(6)
         self.learned_weight = nn.Parameter(torch.zeros(1).requires_grad_())
-        self.gamma = 2
-        self.alpha = 0.25
+        self.derived_constants = DerivedConstants()
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -222,6 +339,60 @@ class MPLUGOwl2LlamaForCausalLM(LlamaForCausalLM, MPLUGOwl2MetaForCausalLM):
     def get_Loss(self):
         return self.Loss
 
+    def score_head(self, hidden_states):
+        # score logits [..., img_token_num]: the [IMG*] columns of lm_head, called as a module so that a ZeRO-3
+        # partitioned weight is gathered (its raw .weight is an empty placeholder outside forward). Callers pass
+        # only the scored positions, so the full-vocabulary projection is a few rows.
+        return self.lm_head(hidden_states)[..., -self.config.img_token_num:]
+
+    def score_logits(self, input_ids, images=None, image_features=None, attention_mask=None, past_key_values=None):
+        # Score logits [batch, img_token_num] at the last position of every row, e.g. after a prompt ending with
+        # the answer prefix: one decoder pass without lm_head over the sequence, so the only projection is
+        # score_head on one position per row. `past_key_values` is a prompt-prefix cache (of batch size 1 or
+        # batch_size).
+        input_ids, modality_indicators, attention_mask, past_key_values, inputs_embeds, _ = \
+            self.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, None, images,
+                                                      image_features)
+        outputs = self.model(
+            input_ids=input_ids,
+            modality_indicators=modality_indicators,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            inputs_embeds=inputs_embeds,
+            use_cache=False,
+            return_dict=True,
+        )
+        return self.score_head(outputs.last_hidden_state[:, -1])
+
+    def get_score_weights(self, device=None):
+        # score of each [IMG*] bin; keyed on the score range since train.py sets it after loading the checkpoint
+        device = torch.device(device) if device is not None else self.device
+        config = self.config
+        return self.derived_constants.get(
+            ("score_weights", config.min_score, config.max_score, config.num_tokens, device),
+            lambda: torch.linspace(config.min_score, config.max_score, config.num_tokens, device=device),
+        )
+
+    def score_loss(self, score_logits, target=None, gt_score=None):
+        # weighted ROC losses of the [IMG*] logits of the [SCORE] tokens [num_scores, img_token_num] against the
+        # target distributions and the ground-truth scores; a term is only computed when its weight is non-zero
+        config = self.config
+        loss = score_logits.new_zeros(())
+        score = torch.softmax(score_logits, dim=1)
+        if target is not None and (config.emd_weight != 0 or config.ce_weight != 0):
+            target = target.view(-1, config.img_token_num)
+            assert target.shape == score.shape
+            if config.emd_weight != 0:
+                # EMD between the cdfs over the score bins
+                cdf_diff = torch.cumsum(score, dim=1) - torch.cumsum(target, dim=1)
+                loss = loss + config.emd_weight * torch.sqrt(torch.mean(torch.pow(torch.abs(cdf_diff), 2)))
+            if config.ce_weight != 0:
+                loss = loss + config.ce_weight * F.cross_entropy(score_logits, target)
+        if config.l1_weight != 0:
+            score = (score * self.get_score_weights(score.device)).sum(dim=1)
+            loss = loss + config.l1_weight * F.smooth_l1_loss(score, gt_score.view(-1))
+        return loss
+
     def forward(
         self,
         input_ids: torch.LongTensor = None,
@@ -237,14 +408,23 @@ class MPLUGOwl2LlamaForCausalLM(LlamaForCausalLM, MPLUGOwl2MetaForCausalLM):
         output_hidden_states: Optional[bool] = None,
         images: Optional[torch.FloatTensor] = None,
         return_dict: Optional[bool] = None,
+        image_features: Optional[torch.FloatTensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-        input_ids, modality_indicators, attention_mask, past_key_values, inputs_embeds, labels = \
-            self.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, images)
+        if segment_ids is not None:
+            # packed rows; the model derives the positions and the block-diagonal mask from the segment ids
+            modality_indicators, segment_ids, inputs_embeds, labels = \
+                self.prepare_packed_inputs(input_ids, segment_ids, labels, images, image_features)
+            input_ids = attention_mask = None
+        else:
+            input_ids, modality_indicators, attention_mask, past_key_values, inputs_embeds, labels = \
+                self.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, images,
+                                                          image_features)
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
         outputs = self.model(
             input_ids=input_ids,
@@ -255,110 +435,50 @@ class MPLUGOwl2LlamaForCausalLM(LlamaForCausalLM, MPLUGOwl2MetaForCausalLM):
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
-            return_dict=return_dict
+            return_dict=return_dict,
+            segment_ids=segment_ids,
         )
 
         hidden_states = outputs[0]
-        logits = self.lm_head(hidden_states)
+        # In training, config.sparse_logits projects only the labelled positions onto the full vocabulary and
+        # config.loss_chunk_size projects them that many positions at a time in the loss; the [SCORE] positions
+        # then go through score_head, and the [batch, seq_len, vocab_size] logits are neither built nor returned.
+        sparse_logits = labels is not None and getattr(self.config, "sparse_logits", False)
+        loss_chunk_size = getattr(self.config, "loss_chunk_size", 0) if labels is not None else 0
+        logits = None if sparse_logits or loss_chunk_size else self.lm_head(hidden_states)
 
         loss = None
         if labels is not None:
-            # Shift so that tokens < n predict n
-            shift_logits = logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = CrossEntropyLoss()
-            shift_logits = shift_logits.view(-1, self.config.vocab_size)
-            shift_labels = shift_labels.view(-1)
-            # Enable model/pipeline parallelism
-            shift_labels = shift_labels.to(shift_logits.device)
-            loss = loss_fct(shift_logits, shift_labels)
-            if self.config.num_tokens==0:
-                if not return_dict:
-                    output = (logits,) + outputs[1:]
-                    return (loss,) + output if loss is not None else output
-                return CausalLMOutputWithPast(
-                    loss=loss,
-                    logits=logits,
-                    past_key_values=outputs.past_key_values,
-                    hidden_states=outputs.hidden_states,
-                    attentions=outputs.attentions,
-                )
-
-            output_token_index = (labels == self.config.score_id).nonzero()
-            bs=labels.shape[0]
-
-
-            if len(output_token_index):
-                addon_index = torch.ones_like(output_token_index) * (-1)
-                addon_index[:, 0] = 0
-                output_token_index += addon_index
-            score_logits = []
-            score_bs_id=[]
-            for i in range(len(output_token_index)):
-                bs_id, seq_id = output_token_index[i]
-                score_bs_id.append(bs_id)
-                score_logits.append(logits[bs_id:bs_id + 1, seq_id:seq_id + 1, :].view(1, -1))
-            if len(score_logits) == 0:
-                if not return_dict:
-                    output = (logits,) + outputs[1:]
-                    return (loss,) + output if loss is not None else output
-                return CausalLMOutputWithPast(
-                    loss=loss,
-                    logits=logits,
-                    past_key_values=outputs.past_key_values,
-                    hidden_states=outputs.hidden_states,
-                    attentions=outputs.attentions,
-                )
+            if sparse_logits:
+                shift_labels = labels[..., 1:]
+                rows, cols = (shift_labels != IGNORE_INDEX).nonzero(as_tuple=True)
+                if loss_chunk_size:
+                    loss = chunked_cross_entropy(hidden_states[rows, cols].unsqueeze(0),
+                                                 shift_labels[rows, cols].unsqueeze(0), loss_chunk_size, self.lm_head)
+                else:
+                    loss = F.cross_entropy(self.lm_head(hidden_states[rows, cols]), shift_labels[rows, cols])
+            elif loss_chunk_size:
+                loss = chunked_cross_entropy(hidden_states[:, :-1], labels[:, 1:], loss_chunk_size, self.lm_head)
             else:
-                score_logits = torch.cat(score_logits, dim=0)
-            score = torch.softmax(score_logits[:, -self.config.img_token_num:], dim=1)
-
-            #EMD loss
-            if target is not None:
-                target = target.view(-1, self.config.img_token_num)
-                assert target.shape == score.shape
-                # cdf for values [1, 2, ..., 10]
-                cdf_target = torch.cumsum(target, dim=1)
-                # cdf for values [1, 2, ..., 10]
-                cdf_estimate = torch.cumsum(score, dim=1)
-                cdf_diff = cdf_estimate - cdf_target
-                samplewise_emd = torch.sqrt(torch.mean(torch.pow(torch.abs(cdf_diff), 2)))
-                emd_loss = samplewise_emd.mean()
-                if self.config.emd_weight != 0:
-                    loss = loss + self.config.emd_weight * emd_loss
-                # CE loss
-                ce_loss_fct = CrossEntropyLoss()
-                ce_loss=ce_loss_fct(score_logits[:, -self.config.img_token_num:],target)
-                if self.config.ce_weight != 0:
-                    loss = loss + self.config.ce_weight * ce_loss
-                #KL
-
-                kl_loss_fct = nn.KLDivLoss(reduction="batchmean", log_target=True)
-                kl_loss = kl_loss_fct(F.log_softmax(score_logits[:, -self.config.img_token_num:],dim=1), F.softmax(target,dim=1))
-
-                #FL
-                BCE_loss = F.binary_cross_entropy_with_logits(score_logits[:, -self.config.img_token_num:], target, reduction='none')
-                pt = torch.exp(-BCE_loss)
-                focal_loss = self.alpha * (1 - pt) ** self.gamma * BCE_loss
-                focal_loss=focal_loss.mean()
-
-
-            # L1 loss
-            score_loss_fct=nn.SmoothL1Loss()
-            import numpy as np
-            w = torch.from_numpy(np.linspace(self.config.min_score, self.config.max_score, self.config.num_tokens)).to(score.device)
-            w = w.type(torch.FloatTensor)
-            w_batch = w.repeat(score.size(0), 1).to(score.device)
-
-            score = (score * w_batch).sum(dim=1).view(bs,-1)
-            gt_score=gt_score
-            l1_loss=score_loss_fct(score.view(-1),gt_score.view(-1))
-
-            if self.config.l1_weight!=0:
-                loss=loss+self.config.l1_weight*l1_loss
-
-            loss=loss
+                # Shift so that tokens < n predict n
+                shift_logits = logits[..., :-1, :].contiguous()
+                shift_labels = labels[..., 1:].contiguous()
+                # Flatten the tokens
+                loss_fct = CrossEntropyLoss()
+                shift_logits = shift_logits.view(-1, self.config.vocab_size)
+                shift_labels = shift_labels.view(-1)
+                # Enable model/pipeline parallelism
+                shift_labels = shift_labels.to(shift_logits.device)
+                loss = loss_fct(shift_logits, shift_labels)
+            if self.config.num_tokens != 0:
+                score_rows, score_cols = (labels == self.config.score_id).nonzero(as_tuple=True)
+                if len(score_rows):
+                    # [IMG*] logits at the position before every [SCORE] label, gathered in one indexing op
+                    if logits is None:
+                        score_logits = self.score_head(hidden_states[score_rows, score_cols - 1])
+                    else:
+                        score_logits = logits[score_rows, score_cols - 1, -self.config.img_token_num:]
+                    loss = loss + self.score_loss(score_logits, target, gt_score)
         if not return_dict:
             output = (logits,) + outputs[1:]
             return (loss,) + output if loss is not None else output
@@ -372,10 +492,20 @@ class MPLUGOwl2LlamaForCausalLM(LlamaForCausalLM, MPLUGOwl2MetaForCausalLM):
         )
 
     def prepare_inputs_for_generation(
-        self, input_ids, past_key_values=None, attention_mask=None, inputs_embeds=None, **kwargs
+        self, input_ids, past_key_values=None, attention_mask=None, inputs_embeds=None, prefix_key_values=None,
+        static_cache_length=None, **kwargs
     ):
         if past_key_values:
             input_ids = input_ids[:, -1:]
+        else:
+            if prefix_key_values is not None:
+                # first step on top of a precomputed prompt prefix: `input_ids` only holds the rest of the prompt
+                past_key_values = prefix_key_values
+            if static_cache_length is not None:
+                # one preallocated cache for the whole generation, written in place at every step
+                cache = StaticKVCache(self.config, input_ids.shape[0], static_cache_length,
+                                      self.get_model().embed_tokens.weight.dtype, input_ids.device)
+                past_key_values = cache if past_key_values is None else cache.fill(past_key_values)
 
         # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
         if inputs_embeds is not None and past_key_values is None:
@@ -389,6 +519,7 @@ class MPLUGOwl2LlamaForCausalLM(LlamaForCausalLM, MPLUGOwl2MetaForCausalLM):
                 "use_cache": kwargs.get("use_cache"),
                 "attention_mask": attention_mask,
                 "images": kwargs.get("images", None),
+                "image_features": kwargs.get("image_features", None),
             }
         )
         return model_inputs
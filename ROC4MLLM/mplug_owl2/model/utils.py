@@ -1,6 +1,34 @@
+from collections import Counter
+
 from transformers import AutoConfig
 
 
+class DerivedConstants:
+    """Per-model registry of tensors derived from the config or the prompt (score bin weights, repeated prompt ids,
+    the prompt-prefix KV cache).
+
+    Entries are built on first use and reused afterwards; `allocations` counts the builds per entry kind and `hits`
+    the reuses, so a steady-state inference loop should only ever increase `hits`.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self.allocations = Counter()
+        self.hits = Counter()
+
+    def get(self, key, factory):
+        value = self._cache.get(key)
+        if value is None:
+            value = self._cache[key] = factory()
+            self.allocations[key[0]] += 1
+        else:
+            self.hits[key[0]] += 1
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+
 def auto_upgrade(config):
     cfg = AutoConfig.from_pretrained(config)
     if 'mplug_owl2' in config and 'mplug_owl2' not in cfg.model_type:
@@ -184,37 +184,13 @@ class MplugOwlVisionAttention(nn.Module):
             mixed_qkv[1],
             mixed_qkv[2],
         )
-        # if self.config.use_flash_attn and flash_attn_func is not None:
-        if False:
-            # [b*sq, np, hn]
-            query_states = query_states.permute(0, 2, 1, 3).contiguous()
-            query_states = query_states.view(query_states.size(0) * query_states.size(1), query_states.size(2), -1)
-
-            key_states = key_states.permute(0, 2, 1, 3).contiguous()
-            key_states = key_states.view(key_states.size(0) * key_states.size(1), key_states.size(2), -1)
-
-            value_states = value_states.permute(0, 2, 1, 3).contiguous()
-            value_states = value_states.view(value_states.size(0) * value_states.size(1), value_states.size(2), -1)
-
-            cu_seqlens = torch.arange(
-                0, (bsz + 1) * seq_len, step=seq_len, dtype=torch.int32, device=query_states.device
-            )
-
-            context_layer = flash_attn_func(
-                query_states,
-                key_states,
-                value_states,
-                cu_seqlens,
-                cu_seqlens,
-                seq_len,
-                seq_len,
-                self.dropout if self.training else 0.0,
-                softmax_scale=self.scale,
-                causal=False,
-                return_attn_probs=False,
-            )
-            # [b*sq, np, hn] => [b, sq, np, hn]
-            context_layer = context_layer.view(bsz, seq_len, context_layer.size(1), context_layer.size(2))
+        if self.config.attention_backend == "sdpa" and head_mask is None and not output_attentions:
+            # fused attention, the [b, np, sq, sq] probabilities are never materialised on kernels that support it
+            context_layer = torch.nn.functional.scaled_dot_product_attention(
+                query_states, key_states, value_states,
+                dropout_p=self.config.attention_dropout if self.training else 0.0,
+            ).permute(0, 2, 1, 3)
+            attention_probs = None
         else:
             # Take the dot product between "query" and "key" to get the raw attention scores.
             attention_scores = torch.matmul(query_states, key_states.transpose(-1, -2))
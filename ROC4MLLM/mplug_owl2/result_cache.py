@@ -0,0 +1,170 @@
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import torch
+from PIL import Image
+
+
+def assessment_identity(assessment):
+    # Everything besides the pixels that changes an assessment result: the checkpoint (path, and the size and
+    # mtime of its files when it is a local folder), the prompt, the score range and the decoding budget.
+    config = assessment.model.config
+    checkpoint = getattr(config, "_name_or_path", "")
+    files = []
+    if checkpoint and os.path.isdir(checkpoint):
+        for path in sorted(glob.glob(os.path.join(checkpoint, "*"))):
+            stat = os.stat(path)
+            files.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    identity = {
+        "checkpoint": checkpoint,
+        "files": files,
+        "prompt": assessment.prompt,
+        "score": [config.min_score, config.max_score, config.num_tokens],
+        "max_score_steps": assessment.max_score_steps,
+        "background_color": assessment.background_color,
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def image_digest(image):
+    # Hash of the decoded RGB pixels of a PIL image or an image file path, so the same image gets the same key
+    # whether it reaches the cache as an upload, a file or (through precomputed `digests`) a preprocessed tensor.
+    if isinstance(image, str):
+        with Image.open(image) as img:
+            image = img.convert('RGB')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"rgb:{image.size}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    # (comment, score) results by key, in an in-process LRU of `max_entries` and, when `path` is given, an
+    # SQLite file of at most `max_disk_mb` from which the least recently used entries are evicted.
+
+    def __init__(self, max_entries=10000, path=None, max_disk_mb=1024):
+        self.max_entries = max_entries
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counter(memory_hits=0, disk_hits=0, misses=0, disk_evictions=0)
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, comment TEXT, score REAL, "
+                             "size INTEGER, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+            self._db.commit()
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self._memory[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT comment, score FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    self.counters["disk_hits"] += 1
+                    self._remember(key, row)
+                    return row
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        comment, score = value
+        with self._lock:
+            self._remember(key, (comment, score))
+            if self._db is not None:
+                size = len(key) + len(comment.encode()) + 64
+                old = self._db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+                self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                                 (key, comment, score, size, time.time()))
+                self._disk_bytes += size - (old[0] if old else 0)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict()
+                self._db.commit()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        # drop the least recently used rows down to 90% of the budget, so eviction does not run on every put
+        target = 0.9 * self.max_disk_bytes
+        rows = self._db.execute("SELECT key, size FROM results ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._disk_bytes <= target:
+                break
+            evicted.append((key,))
+            self._disk_bytes -= size
+        self._db.executemany("DELETE FROM results WHERE key = ?", evicted)
+        self.counters["disk_evictions"] += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            lookups = hits + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes if self._db is not None else 0,
+            }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+class CachedAssessment:
+    # Drop-in wrapper of Assessment.__call__ that only runs the model for images whose result is not cached.
+    # Identical images within one call are scored once. Images are keyed by image_digest(); for preprocessed
+    # tensors, whose pixels are gone, the caller passes the image_digest() of their source images as `digests`.
+
+    def __init__(self, assessment, cache):
+        self.assessment = assessment
+        self.cache = cache
+        self.identity = assessment_identity(assessment)
+
+    def __getattr__(self, name):
+        return getattr(self.assessment, name)
+
+    def __call__(self, image, precision=4, mode="comment", digests=None):
+        if digests is None:
+            if torch.is_tensor(image):
+                raise ValueError("tensor images need the digests of their source images")
+            digests = [image_digest(img) for img in image]
+        keys = [f"{self.identity}:{mode}:{precision}:{digest}" for digest in digests]
+        results = [self.cache.get(key) for key in keys]
+        missing = {}
+        for i, (key, result) in enumerate(zip(keys, results)):
+            if result is None:
+                missing.setdefault(key, i)
+        if missing:
+            indices = list(missing.values())
+            if torch.is_tensor(image):
+                batch = image[indices]
+            else:
+                batch = [image[i] for i in indices]
+            answer, score = self.assessment(batch, precision=precision, mode=mode)
+            for key, comment, image_score in zip(missing, answer, score):
+                self.cache.put(key, (comment, image_score))
+            computed = dict(zip(missing, zip(answer, score)))
+            results = [computed[key] if result is None else result for key, result in zip(keys, results)]
+        return [comment for comment, _ in results], [score for _, score in results]
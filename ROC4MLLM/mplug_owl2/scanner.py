@@ -0,0 +1,106 @@
+import os
+
+# extensions looked at by default, compared case-insensitively; the header decides whether a file is an image
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.jpe', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+
+
+def sniff_image(path, size=None):
+    # Image format from the magic bytes, or None for files that are not images or are visibly truncated (a PNG
+    # without its IEND chunk). JPEGs are only checked by their magic bytes: valid ones often carry data after
+    # the end-of-image marker (motion photos, camera padding, appended metadata).
+    with open(path, 'rb') as f:
+        head = f.read(16)
+        if head.startswith(b"\xff\xd8\xff"):
+            return "jpeg"
+        elif head.startswith(b"\x89PNG\r\n\x1a\n"):
+            image_format, trailer, tail_size = "png", b"IEND", 12
+        elif head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "webp"
+        elif head[:6] in (b"GIF87a", b"GIF89a"):
+            return "gif"
+        elif head[:2] == b"BM":
+            return "bmp"
+        elif head[:4] in (b"II*\x00", b"MM\x00*"):
+            return "tiff"
+        else:
+            return None
+        size = os.fstat(f.fileno()).st_size if size is None else size
+        f.seek(max(0, size - tail_size))
+        return image_format if trailer in f.read(tail_size) else None
+
+
+def scan_directory(input_dir, extensions=IMAGE_EXTENSIONS, sniff=True, rejected=None, skip_hidden=False):
+    # Lazily yields (full_path, rel_path, size, mtime_ns) of the images under input_dir, depth-first in sorted
+    # order, so scoring starts as soon as the first image is found. `extensions=None` looks at every file.
+    # Directory symlinks are not followed, as with os.walk. The files with an image extension that the sniff
+    # rejects are appended to the `rejected` list, if given, so that they can be reported. Files and directories
+    # whose name starts with '.' are only skipped with `skip_hidden`.
+    stack = [input_dir]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"\nCannot list {directory}: {e}")
+            continue
+        subdirectories = []
+        for entry in entries:
+            if skip_hidden and entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_symlink() and entry.is_dir():
+                continue
+            elif extensions is None or entry.name.lower().endswith(extensions):
+                try:
+                    stat = entry.stat()
+                    task = entry.path, os.path.relpath(entry.path, input_dir), stat.st_size, stat.st_mtime_ns
+                    if sniff and sniff_image(entry.path, stat.st_size) is None:
+                        if rejected is not None and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                            rejected.append(task)
+                        continue
+                except OSError:
+                    continue
+                yield task
+        stack.extend(reversed(subdirectories))
+
+
+def read_manifest(manifest_path, input_dir, sniff=False, rejected=None):
+    # Same tasks as scan_directory from a manifest instead of a walk: one path per line, relative to input_dir
+    # or absolute, optionally followed by tab-separated size and mtime_ns (as written by write_manifest) to
+    # avoid a stat per file. Blank lines and lines starting with '#' are skipped. Sniff rejections are appended
+    # to `rejected`, if given.
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            full_path = os.path.join(input_dir, fields[0])
+            rel_path = os.path.relpath(full_path, input_dir)
+            try:
+                if len(fields) >= 3:
+                    size, mtime_ns = int(fields[1]), int(fields[2])
+                else:
+                    stat = os.stat(full_path)
+                    size, mtime_ns = stat.st_size, stat.st_mtime_ns
+                if sniff and sniff_image(full_path, size) is None:
+                    if rejected is not None:
+                        rejected.append((full_path, rel_path, size, mtime_ns))
+                    continue
+            except OSError as e:
+                print(f"\nSkipping {rel_path}: {e}")
+                continue
+            yield full_path, rel_path, size, mtime_ns
+
+
+def write_manifest(tasks, manifest_path):
+    # passes the tasks through while writing them as a manifest that read_manifest can load; the manifest
+    # only replaces an existing one once the scan is complete
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for task in tasks:
+            f.write(f"{task[1]}\t{task[2]}\t{task[3]}\n")
+            yield task
+    os.replace(tmp_path, manifest_path)
@@ -0,0 +1,213 @@
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from PIL import Image
+
+from mplug_owl2.mm_utils import expand2square
+from mplug_owl2.result_cache import image_digest
+
+
+def processor_config_hash(image_processor, image_aspect_ratio="pad"):
+    # everything that changes the preprocessed tensors; a store built with another config is discarded
+    config = image_processor.to_dict()
+    return hashlib.sha256(json.dumps([config, image_aspect_ratio], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def module_fingerprint(*modules):
+    # cheap identity of module weights: names, shapes and a strided sample of every parameter
+    digest = hashlib.sha256()
+    for module in modules:
+        for name, param in module.named_parameters():
+            values = param.detach().flatten()
+            values = values[::max(1, values.numel() // 256)][:256].float().cpu().numpy()
+            digest.update(f"{name}:{tuple(param.shape)}:{param.dtype}:".encode())
+            digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+class MmapTensorStore:
+    # Tensors of one fixed shape kept as fp16 rows of one memory-mapped shard, `tensors.f16`, plus an
+    # append-only `index.jsonl` of {"key", "row"} and optional fields (see info()). Keys are the real path, size
+    # and mtime of the image file, so edited images are computed again, and `config_hash` describes how the
+    # tensors were made: a store built with another config is discarded. Appends take an exclusive lock on the
+    # shard, so several processes (data loader workers, rate.py workers) can fill the same store; a row is
+    # written before its index line, so readers never see an incomplete row.
+
+    def __init__(self, root, shape, config_hash):
+        self.root = root
+        self.shape = tuple(shape)
+        self.row_bytes = int(np.prod(self.shape)) * 2
+        self.config_hash = config_hash
+        self.shard_path = os.path.join(root, "tensors.f16")
+        self.index_path = os.path.join(root, "index.jsonl")
+        os.makedirs(root, exist_ok=True)
+        with self._locked():
+            meta_path = os.path.join(root, "meta.json")
+            meta = None
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+            if meta != {"config_hash": self.config_hash, "shape": list(self.shape)}:
+                # new store, or one built by another config
+                for path in (self.shard_path, self.index_path):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                with open(meta_path, 'w') as f:
+                    json.dump({"config_hash": self.config_hash, "shape": list(self.shape)}, f)
+        self._rows = {}
+        self._info = {}
+        self._index_offset = 0
+        self._mmap = None
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.root, "lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __getstate__(self):
+        # the memory map is reopened by each process the store is sent to
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        return state
+
+    def __len__(self):
+        self._refresh()
+        return len(self._rows)
+
+    def key(self, path, size=None, mtime_ns=None):
+        if size is None or mtime_ns is None:
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        return f"{os.path.realpath(path)}\t{size}\t{mtime_ns}"
+
+    def _refresh(self):
+        # read the index lines appended since the last refresh, by this or another process
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self._rows[entry["key"]] = entry.pop("row")
+            self._info[entry.pop("key")] = entry
+        self._index_offset += end
+
+    def get(self, key):
+        # float32 tensor of the image, or None if it is not stored
+        row = self._rows.get(key)
+        if row is None:
+            self._refresh()
+            row = self._rows.get(key)
+            if row is None:
+                return None
+        if self._mmap is None or row >= len(self._mmap):
+            num_rows = os.path.getsize(self.shard_path) // self.row_bytes
+            self._mmap = np.memmap(self.shard_path, dtype=np.float16, mode='r', shape=(num_rows,) + self.shape)
+        return torch.from_numpy(self._mmap[row].astype(np.float32))
+
+    def info(self, key):
+        # the extra fields stored with the tensor of `key` by put()
+        if key not in self._info:
+            self._refresh()
+        return self._info.get(key, {})
+
+    def put(self, key, tensor, **info):
+        data = tensor.detach().cpu().to(torch.float16).contiguous().numpy()
+        if data.shape != self.shape:
+            raise ValueError(f"expected a tensor of shape {self.shape}, got {data.shape}")
+        with self._locked():
+            with open(self.shard_path, 'ab') as f:
+                end = f.seek(0, os.SEEK_END)
+                if end % self.row_bytes:
+                    # drop the partial row of a writer that was killed mid-append
+                    end = f.truncate(end - end % self.row_bytes)
+                row = end // self.row_bytes
+                f.write(data.tobytes())
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"key": key, "row": row, **info}, ensure_ascii=False) + "\n")
+        self._rows[key] = row
+        self._info[key] = info
+
+
+class TensorStore(MmapTensorStore):
+    # Preprocessed images (padded, resized and normalized), as read by rate.py, Assessment and the training set.
+    # Every aspect mode has its own subdirectory of `root`, so rate.py ("pad") and training (by default "square")
+    # can share one directory without discarding each other's store.
+
+    def __init__(self, root, image_processor, image_aspect_ratio="pad"):
+        self.image_processor = image_processor
+        self.image_aspect_ratio = image_aspect_ratio
+        self.background_color = tuple(int(x * 255) for x in image_processor.image_mean)
+        crop_size = image_processor.crop_size
+        super().__init__(os.path.join(root, image_aspect_ratio), (3, crop_size['height'], crop_size['width']),
+                         processor_config_hash(image_processor, image_aspect_ratio))
+
+    def preprocess(self, image):
+        if self.image_aspect_ratio == 'pad':
+            image = expand2square(image, self.background_color)
+        return self.image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+
+    def load(self, path, size=None, mtime_ns=None, with_digest=False):
+        # stored tensor of an image file, decoded and stored on the first call; with `with_digest`, also the
+        # image_digest() of the decoded pixels (the ResultCache key), stored along with the tensor
+        key = self.key(path, size, mtime_ns)
+        tensor = self.get(key)
+        digest = self.info(key).get("digest") if tensor is not None else None
+        if tensor is None or (with_digest and digest is None):
+            image = Image.open(path).convert('RGB')
+            digest = image_digest(image)
+            if tensor is None:
+                tensor = self.preprocess(image)
+                self.put(key, tensor, digest=digest)
+                # same fp16 rounding as the later reads
+                tensor = tensor.half().float()
+        return (tensor, digest) if with_digest else tensor
+
+
+class VisionFeatureStore(MmapTensorStore):
+    # Visual abstractor outputs ([num_queries + 1, hidden] per image) for the `image_features` argument of
+    # MPLUGOwl2LlamaForCausalLM, so prompt or LLM-side sweeps over the same images skip the vision tower. The
+    # config hash covers the image preprocessing and the vision model and abstractor weights, not the LLM.
+
+    def __init__(self, root, model, image_processor):
+        self.model = model
+        self.image_processor = image_processor
+        self.background_color = tuple(int(x * 255) for x in image_processor.image_mean)
+        abstractor = model.get_model().visual_abstractor
+        config_hash = hashlib.sha256((processor_config_hash(image_processor) + module_fingerprint(
+            model.get_model().vision_model, abstractor)).encode()).hexdigest()
+        super().__init__(root, (abstractor.query_embeds.shape[1] + 1, model.config.hidden_size), config_hash)
+
+    def __getstate__(self):
+        raise TypeError("VisionFeatureStore holds the model, create one per process instead")
+
+    def load(self, paths):
+        # [batch, num_queries + 1, hidden] float32 features of the image files; the missing ones are encoded in
+        # one batch and stored
+        keys = [self.key(path) for path in paths]
+        features = [self.get(key) for key in keys]
+        missing = [i for i, feature in enumerate(features) if feature is None]
+        if missing:
+            images = [expand2square(Image.open(paths[i]).convert('RGB'), self.background_color) for i in missing]
+            pixel_values = self.image_processor.preprocess(images, return_tensors='pt')['pixel_values']
+            vision_model = self.model.get_model().vision_model
+            with torch.inference_mode():
+                encoded = self.model.encode_images(pixel_values.to(vision_model.device, dtype=vision_model.dtype))
+            for i, feature in zip(missing, encoded):
+                self.put(keys[i], feature)
+                features[i] = feature.half().float().cpu()
+        return torch.stack(features)
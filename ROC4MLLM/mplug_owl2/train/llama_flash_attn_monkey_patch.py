@@ -1,3 +1,4 @@
+from collections import namedtuple
 from typing import Optional, Tuple
 import warnings
 
@@ -12,6 +13,10 @@ except ImportError:
     from flash_attn.flash_attn_interface import flash_attn_varlen_qkvpacked_func as flash_attn_unpadded_qkvpacked_func
 from flash_attn.bert_padding import unpad_input, pad_input
 
+# The samples of packed rows as flash attention sequences: `indices` of the non-padding tokens in the flattened
+# [bsz * seq_len] batch, and the cumulative sample lengths `cu_seqlens` over those tokens.
+PackedSegments = namedtuple("PackedSegments", ["indices", "cu_seqlens", "max_seqlen"])
+
 
 def forward(
     self,
@@ -72,7 +77,14 @@ def forward(
     qkv = qkv.transpose(1, 3)  # shape: [b, s, 3, num_heads, head_dim]
     key_padding_mask = attention_mask
 
-    if key_padding_mask is None:
+    if isinstance(key_padding_mask, PackedSegments):
+        qkv = qkv.reshape(bsz * q_len, 3, self.num_heads, self.head_dim)[key_padding_mask.indices]
+        output_unpad = flash_attn_unpadded_qkvpacked_func(
+            qkv, key_padding_mask.cu_seqlens, key_padding_mask.max_seqlen, 0.0, softmax_scale=None, causal=True
+        )
+        output_unpad = output_unpad.reshape(-1, self.num_heads * self.head_dim)
+        output = pad_input(output_unpad, key_padding_mask.indices, bsz, q_len)
+    elif key_padding_mask is None:
         qkv = qkv.reshape(-1, 3, self.num_heads, self.head_dim)
         cu_q_lens = torch.arange(
             0, (bsz + 1) * q_len, step=q_len, dtype=torch.int32, device=qkv.device
@@ -104,6 +116,17 @@ def _prepare_decoder_attention_mask(
     return attention_mask
 
 
+# Packed rows: every sample is its own causal sequence for flash attention
+def _prepare_packed_attention_mask(self, segment_ids, inputs_embeds):
+    flat = segment_ids.flatten()
+    indices = torch.nonzero(flat > 0).flatten()
+    # offset the segment ids of every row so that equal ids of different rows stay separate sequences
+    row_offset = torch.arange(segment_ids.shape[0], device=segment_ids.device) * (int(segment_ids.max()) + 1)
+    _, seqlens = torch.unique_consecutive((segment_ids + row_offset[:, None]).flatten()[indices], return_counts=True)
+    cu_seqlens = torch.nn.functional.pad(seqlens.cumsum(0, dtype=torch.int32), (1, 0))
+    return PackedSegments(indices, cu_seqlens, int(seqlens.max()))
+
+
 def replace_llama_attn_with_flash_attn():
     cuda_major, cuda_minor = torch.cuda.get_device_capability()
     if cuda_major < 8:
@@ -114,4 +137,7 @@ def replace_llama_attn_with_flash_attn():
     transformers.models.llama.modeling_llama.LlamaModel._prepare_decoder_attention_mask = (
         _prepare_decoder_attention_mask
     )
+    transformers.models.llama.modeling_llama.LlamaModel._prepare_packed_attention_mask = (
+        _prepare_packed_attention_mask
+    )
     transformers.models.llama.modeling_llama.LlamaAttention.forward = forward
\ No newline at end of file
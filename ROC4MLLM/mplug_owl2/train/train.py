@@ -34,6 +34,7 @@ from mplug_owl2.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_
 from mplug_owl2 import conversation as conversation_lib
 from mplug_owl2.model import *
 from mplug_owl2.mm_utils import tokenizer_image_token
+from mplug_owl2.tensor_store import TensorStore
 
 from PIL import Image
 from icecream import ic
@@ -84,6 +85,12 @@ class ModelArguments:
     l1_weight: float=0
     emd_weight: float=0
     ce_weight: float=0
+    sparse_logits: bool = field(default=False,
+                                metadata={"help": "Project only the labelled positions onto the vocabulary and the "
+                                                  "[SCORE] positions onto the [IMG*] tokens in the training loss."})
+    loss_chunk_size: int = field(default=0,
+                                 metadata={"help": "Compute the text loss over this many positions at a time, "
+                                                   "recomputed in backward, to bound its memory (0: all at once)."})
 
 
 @dataclass
@@ -95,6 +102,15 @@ class DataArguments:
     image_folder: Optional[str] = field(default=None)
     image_aspect_ratio: str = 'square'
     image_grid_pinpoints: Optional[str] = field(default=None)
+    tensor_store: Optional[str] = field(default=None,
+                                        metadata={"help": "Directory of preprocessed image tensors, filled on the "
+                                                          "first epoch and read instead of decoding afterwards."})
+    packing: bool = field(default=False,
+                          metadata={"help": "Pack several samples into each row of a batch instead of padding every "
+                                            "sample to the longest one; samples attend only to themselves."})
+    pack_length: Optional[int] = field(default=None,
+                                       metadata={"help": "Length of a packed row, counting the visual tokens of its "
+                                                         "images (default: model_max_length)."})
 
 
 @dataclass
@@ -516,6 +532,10 @@ class LazySupervisedDataset(Dataset):
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
         self.data_args = data_args
+        self.tensor_store = None
+        if data_args.tensor_store is not None:
+            self.tensor_store = TensorStore(data_args.tensor_store, data_args.image_processor,
+                                            data_args.image_aspect_ratio)
 
     def __len__(self):
         return len(self.list_data_dict)
@@ -622,6 +642,13 @@ class LazySupervisedDataset(Dataset):
                             image = processor.preprocess(image, return_tensors='pt')['pixel_values']
                         else:
                             image = processor.preprocess(image, return_tensors='pt')['pixel_values']
+                    elif self.tensor_store is not None:
+                        try:
+                            image = self.tensor_store.load(os.path.join(image_folder, image_file))
+                        except Exception as ex:
+                            print(ex)
+                            i=self.next_rand()
+                            continue
                     else:
                         try:
                             image = Image.open(os.path.join(image_folder, image_file)).convert('RGB')
@@ -714,13 +741,89 @@ class DataCollatorForSupervisedDataset(object):
         return batch
 
 
+@dataclass
+class PackedDataCollatorForSupervisedDataset(object):
+    """Collate examples for supervised fine-tuning into packed rows.
+
+    The samples are packed first-fit, longest first, into rows of at most `pack_length` tokens, counting the
+    `image_token_len` visual tokens each image token expands to. `segment_ids` numbers the samples of a row from 1
+    (0 is padding); the model restarts the positions and masks the attention per sample. `images`, `target` and
+    `gt_score` follow the row-major order of the samples, which is the order of their [SCORE] tokens.
+    """
+
+    tokenizer: transformers.PreTrainedTokenizer
+    image_token_len: int
+    pack_length: int
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        samples = []
+        for instance in instances:
+            input_ids = instance['input_ids'][:self.tokenizer.model_max_length]
+            num_images = int((input_ids == IMAGE_TOKEN_INDEX).sum())
+            if num_images > 1:
+                raise ValueError(f"packing supports one image per sample, got {num_images}")
+            samples.append((len(input_ids) + num_images * (self.image_token_len - 1), num_images, instance))
+
+        rows = []  # [packed length, samples]
+        for sample in sorted(samples, key=lambda sample: -sample[0]):
+            for row in rows:
+                if row[0] + sample[0] <= self.pack_length:
+                    row[0] += sample[0]
+                    row[1].append(sample)
+                    break
+            else:
+                rows.append([sample[0], [sample]])
+
+        max_len = max(sum(min(len(instance['input_ids']), self.tokenizer.model_max_length)
+                          for _, _, instance in row) for _, row in rows)
+        input_ids = torch.full((len(rows), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(rows), max_len), IGNORE_INDEX, dtype=torch.long)
+        segment_ids = torch.zeros((len(rows), max_len), dtype=torch.long)
+        images, target, gt_score = [], [], []
+        for i, (_, row) in enumerate(rows):
+            start = 0
+            for segment, (_, num_images, instance) in enumerate(row, 1):
+                length = min(len(instance['input_ids']), self.tokenizer.model_max_length)
+                input_ids[i, start:start + length] = instance['input_ids'][:length]
+                labels[i, start:start + length] = instance['labels'][:length]
+                # the previous sample's last token must not learn to predict this one's first
+                labels[i, start] = IGNORE_INDEX
+                segment_ids[i, start:start + length] = segment
+                start += length
+                if num_images:
+                    images.append(instance['image'])
+                if 'target' in instance:
+                    target.append(torch.FloatTensor(instance['target']))
+                if 'gt_score' in instance:
+                    gt_score.append(torch.FloatTensor([instance['gt_score']]))
+
+        batch = dict(
+            input_ids=input_ids,
+            labels=labels,
+            attention_mask=segment_ids > 0,
+            segment_ids=segment_ids,
+        )
+        if images:
+            batch['images'] = torch.stack(images)
+        if target:
+            batch['target'] = torch.stack(target)
+        if gt_score:
+            batch['gt_score'] = torch.stack(gt_score)
+        return batch
+
+
 def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
                                 data_args) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
     train_dataset = LazySupervisedDataset(tokenizer=tokenizer,
                                           data_path=data_args.data_path,
                                           data_args=data_args)
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+    if data_args.packing:
+        data_collator = PackedDataCollatorForSupervisedDataset(
+            tokenizer=tokenizer, image_token_len=data_args.image_token_len,
+            pack_length=data_args.pack_length or tokenizer.model_max_length)
+    else:
+        data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset,
                 eval_dataset=None,
                 data_collator=data_collator)
@@ -838,6 +941,8 @@ def train():
     model.config.l1_weight=model_args.l1_weight
     model.config.emd_weight=model_args.emd_weight
     model.config.ce_weight=model_args.ce_weight
+    model.config.sparse_logits=model_args.sparse_logits
+    model.config.loss_chunk_size=model_args.loss_chunk_size
 
 
     # word
@@ -909,6 +1014,8 @@ def train():
     data_args.image_processor = CLIPImageProcessor.from_pretrained(
         '/home/mxy/.cache/huggingface/hub/models--MAGAer13--mplug-owl2-llama2-7b/snapshots/200342bbdd0eef019b02b4d7c9b17df235bba4ad/')
     data_args.is_multimodal = True
+    # tokens an image token expands to, for the packed lengths
+    data_args.image_token_len = model.get_model().visual_abstractor.query_embeds.shape[1] + 1
 
 
     model.config.image_aspect_ratio = data_args.image_aspect_ratio
@@ -1,9 +1,213 @@
 import os
-import json
+import time
+import queue
 import argparse
+import itertools
+import threading
+from collections import deque
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
 from tqdm import tqdm
-from mplug_owl2.assessor import Assessment
+from mplug_owl2.assessor import Assessment, preprocess_images
+from mplug_owl2.journal import ResultsJournal
+from mplug_owl2.result_cache import ResultCache, CachedAssessment, image_digest
+from mplug_owl2.scanner import IMAGE_EXTENSIONS, scan_directory, read_manifest, write_manifest
+from mplug_owl2.tensor_store import TensorStore
+
+
+def iter_chunks(tasks, size):
+    tasks = iter(tasks)
+    while chunk := list(itertools.islice(tasks, size)):
+        yield chunk
+
+
+def load_task(task, image_processor, background_color, tensor_store=None, with_digest=False):
+    # decode and preprocess one image, or read it from the tensor store; failures are returned instead of raised.
+    # With `with_digest` (--cache), also the image_digest() of the decoded pixels that keys the result cache.
+    try:
+        if tensor_store is not None:
+            full_path, _, size, mtime_ns = task
+            if with_digest:
+                return (task, *tensor_store.load(full_path, size, mtime_ns, with_digest=True), None)
+            return task, tensor_store.load(full_path, size, mtime_ns), None, None
+        img = Image.open(task[0]).convert('RGB')
+        digest = image_digest(img) if with_digest else None
+        return task, preprocess_images([img], image_processor, background_color)[0], digest, None
+    except Exception as e:
+        return task, None, None, str(e)
+
+
+def collate_tasks(items):
+    # (task, error) of every item in order, the stacked images of the items that decoded and their digests
+    decoded = [(tensor, digest) for _, tensor, digest, _ in items if tensor is not None]
+    image_tensors = torch.stack([tensor for tensor, _ in decoded]) if decoded else None
+    digests = [digest for _, digest in decoded] if decoded and decoded[0][1] is not None else None
+    return [(task, error) for task, _, _, error in items], image_tensors, digests
+
+
+_decoder_args = None
+
+
+def init_decoder(image_processor, background_color, tensor_store, with_digest):
+    global _decoder_args
+    _decoder_args = (image_processor, background_color, tensor_store, with_digest)
+
+
+def prepare_chunk(chunk):
+    return collate_tasks([load_task(task, *_decoder_args) for task in chunk])
+
+
+def prefetch_batches(chunks, image_processor, background_color, num_workers, tensor_store=None, pin_memory=False,
+                     with_digest=False):
+    # Decodes and preprocesses the chunks in `num_workers` processes while the model scores the previous ones,
+    # with at most two chunks per process in flight, and yields the collated batches in order. Tensors come
+    # back through shared memory since torch.multiprocessing is imported. The processes are spawned, as in
+    # run_workers, since the model (and CUDA) is already loaded in this one.
+    if num_workers == 0:
+        for chunk in chunks:
+            yield collate_tasks([load_task(task, image_processor, background_color, tensor_store, with_digest)
+                                 for task in chunk])
+        return
+    with ProcessPoolExecutor(num_workers, mp_context=mp.get_context("spawn"), initializer=init_decoder,
+                             initargs=(image_processor, background_color, tensor_store, with_digest)) as pool:
+        pending = deque()
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                pending.append(pool.submit(prepare_chunk, chunk))
+            while pending and (chunk is None or len(pending) >= 2 * num_workers):
+                entries, image_tensors, digests = pending.popleft().result()
+                if pin_memory and image_tensors is not None:
+                    image_tensors = image_tensors.pin_memory()
+                yield entries, image_tensors, digests
+
+
+def load_assessment(args, device):
+    assessment = Assessment(pretrained=args.model_path, device=device)
+    result_cache = None
+    if args.cache:
+        result_cache = ResultCache(path=args.cache, max_disk_mb=args.cache_mb)
+        assessment = CachedAssessment(assessment, result_cache)
+    return assessment, result_cache
+
+
+def score_batch(assessment, entries, image_tensors, precision, digests=None):
+    # journal records of one collated batch, in order; decode errors and model errors become error records.
+    # `digests` are the result cache keys of the images, for a CachedAssessment.
+    scored = iter(())
+    batch_error = None
+    if image_tensors is not None:
+        try:
+            if digests is not None:
+                answer, score = assessment(image_tensors, precision=precision, digests=digests)
+            else:
+                answer, score = assessment(image_tensors, precision=precision)
+            scored = zip(answer, score)
+        except Exception as e:
+            batch_error = str(e)
+            print(f"\nError processing batch of {len(image_tensors)} images: {e}")
+    records = []
+    for (_, rel_path, size, mtime_ns), error in entries:
+        record = {"file_path": rel_path, "size": size, "mtime_ns": mtime_ns}
+        if error is None and batch_error is None:
+            comment, image_score = next(scored)
+            record.update(score=image_score, comment=comment)
+        else:
+            if error is not None:
+                print(f"\nError processing {rel_path}: {error}")
+            record.update(score=None, comment=f"Error: {error or batch_error}")
+        records.append(record)
+    return records
+
+
+def score_worker(device, num_threads, args, task_queue, result_queue):
+    # One --workers process: loads its own model and takes batches from the shared queue until it is empty,
+    # so fast workers take over the work of slow ones. The next batch is decoded while the current one runs.
+    torch.set_num_threads(num_threads)
+    try:
+        assessment, result_cache = load_assessment(args, device)
+    except Exception as e:
+        result_queue.put(("failed", device, str(e)))
+        return
+
+    tensor_store = TensorStore(args.tensor_store, assessment.image_processor) if args.tensor_store else None
+
+    def prepare(chunk):
+        return collate_tasks([load_task(task, assessment.image_processor, assessment.background_color, tensor_store,
+                                        result_cache is not None) for task in chunk])
+
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        chunk = task_queue.get()
+        batch = prefetch.submit(prepare, chunk) if chunk is not None else None
+        while batch is not None:
+            entries, image_tensors, digests = batch.result()
+            chunk = task_queue.get()
+            batch = prefetch.submit(prepare, chunk) if chunk is not None else None
+            result_queue.put(("records", device,
+                              score_batch(assessment, entries, image_tensors, args.precision, digests)))
+    result_queue.put(("done", device, result_cache.stats() if result_cache is not None else None))
+
+
+def run_workers(args, chunks, devices):
+    # Yields journal records as batches complete on the worker processes. The chunks are queued by a feeder
+    # thread as the scan produces them, so the workers start before the scan is finished.
+    ctx = mp.get_context("spawn")
+    task_queue, result_queue = ctx.Queue(), ctx.Queue()
+    num_threads = max(1, (os.cpu_count() or 1) // args.workers)
+    workers = [ctx.Process(target=score_worker, daemon=True,
+                           args=(devices[i % len(devices)], num_threads, args, task_queue, result_queue))
+               for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    num_chunks = [0]
+    fed = threading.Event()
+
+    def feed():
+        try:
+            for chunk in chunks:
+                task_queue.put(chunk)
+                num_chunks[0] += 1
+        finally:
+            for _ in workers:
+                task_queue.put(None)
+            fed.set()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    num_batches = 0
+    num_running = len(workers)
+    cache_stats = []
+    # every worker ends with a "done" (or "failed") message, which carries its result cache stats, so the
+    # queue is read until all of them have arrived, not only until the last batch is in
+    while num_running:
+        try:
+            kind, device, payload = result_queue.get(timeout=5)
+        except queue.Empty:
+            # a worker that crashed (e.g. out of memory) takes its batch with it; the journal keeps the rest
+            num_running = min(num_running, sum(worker.is_alive() for worker in workers))
+            continue
+        if kind == "records":
+            num_batches += 1
+            yield payload
+        elif kind == "failed":
+            print(f"\nWorker on {device} failed to load the model: {payload}")
+            num_running -= 1
+        elif kind == "done":
+            num_running -= 1
+            if payload is not None:
+                print(f"\nResult cache of worker on {device}: {payload}")
+                cache_stats.append(payload)
+    for worker in workers:
+        worker.join(timeout=60)
+    if cache_stats:
+        hits = sum(stats["memory_hits"] + stats["disk_hits"] for stats in cache_stats)
+        lookups = hits + sum(stats["misses"] for stats in cache_stats)
+        print(f"Result cache of {len(cache_stats)} workers: {hits} hits in {lookups} lookups "
+              f"(hit rate {hits / lookups if lookups else 0.0:.3f})")
+    if not fed.is_set() or num_batches < num_chunks[0]:
+        print(f"\nNot every batch was scored, rerun to resume from the journal")
 
 
 def main():
@@ -17,6 +221,36 @@ def main():
                         help="Path to pretrained model weights")
     parser.add_argument("-p", "--precision", type=int, default=4,
                         help="Number of decimal places for the score")
+    parser.add_argument("-b", "--batch-size", type=int, default=1,
+                        help="Number of images scored per forward pass")
+    parser.add_argument("--num-workers", type=int, default=min(8, os.cpu_count() or 1),
+                        help="Processes that decode and preprocess images (0 = main process)")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Read the images from this manifest instead of walking input_dir: one path "
+                             "relative to input_dir per line, optionally with tab-separated size and mtime_ns")
+    parser.add_argument("--write-manifest", type=str, default=None,
+                        help="Write the scanned images to this manifest for later --manifest runs")
+    parser.add_argument("--any-extension", action="store_true",
+                        help="Look at every file, not only image extensions; the header decides")
+    parser.add_argument("--no-sniff", action="store_true",
+                        help="Trust the extensions instead of checking the image headers")
+    parser.add_argument("--skip-hidden", action="store_true",
+                        help="Skip files and directories whose name starts with '.' (scored by default)")
+    parser.add_argument("--journal", type=str, default=None,
+                        help="Results journal used to resume runs (default: <output_json>.journal.jsonl)")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the journal and score every image again")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="SQLite file caching results by image content, shared between runs and folders")
+    parser.add_argument("--cache-mb", type=float, default=1024,
+                        help="Size limit of the --cache file, least recently used results are evicted")
+    parser.add_argument("--tensor-store", type=str, default=None,
+                        help="Directory of preprocessed fp16 image tensors, filled on the first run and read "
+                             "instead of decoding on later runs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes that each load a model and take batches from a shared queue")
+    parser.add_argument("--devices", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        help="Comma-separated devices assigned round-robin to the workers, e.g. cuda:0,cuda:1")
 
     args = parser.parse_args()
 
@@ -38,62 +272,87 @@ def main():
             final_output_path = os.path.join(parent_dir, args.output_json)
     # ----------------------------------------
 
-    # 2. Initialize Model
-    print(f"Loading model from: {args.model_path} ...")
-    try:
-        assessment = Assessment(pretrained=args.model_path)
-    except Exception as e:
-        print(f"Failed to load model: {e}")
-        return
+    # 2. Initialize Model, the --workers processes load their own
+    devices = args.devices.split(",")
+    assessment = result_cache = None
+    if args.workers <= 1:
+        print(f"Loading model from: {args.model_path} ...")
+        try:
+            assessment, result_cache = load_assessment(args, devices[0])
+        except Exception as e:
+            print(f"Failed to load model: {e}")
+            return
 
-    # 3. Recursively collect image files
-    valid_extensions = ('.jpg', '.jpeg', '.png', '.JPG', '.PNG')
-    image_tasks = []
+    # 3. Lazily collect image files, scoring starts with the first batch found
+    # image files whose header is not a (complete) image, reported as errors once the scan is done
+    rejected = []
+    if args.manifest:
+        image_tasks = read_manifest(args.manifest, args.input_dir, sniff=not args.no_sniff, rejected=rejected)
+    else:
+        image_tasks = scan_directory(args.input_dir, extensions=None if args.any_extension else IMAGE_EXTENSIONS,
+                                     sniff=not args.no_sniff, rejected=rejected, skip_hidden=args.skip_hidden)
+    if args.write_manifest:
+        image_tasks = write_manifest(image_tasks, args.write_manifest)
 
-    for root, _, files in os.walk(args.input_dir):
-        for file in files:
-            if file.endswith(valid_extensions):
-                full_path = os.path.join(root, file)
-                # Calculate relative path for better JSON organization
-                rel_path = os.path.relpath(full_path, args.input_dir)
-                image_tasks.append((full_path, rel_path))
+    # Images scored by an earlier run are skipped unless they changed since
+    journal = ResultsJournal(args.journal or final_output_path + ".journal.jsonl")
+    if args.restart:
+        journal.clear()
+    found_paths = []
+    num_skipped = [0]
 
-    if not image_tasks:
-        print(f"No valid image files found in: {args.input_dir}")
-        return
+    def pending_tasks():
+        for task in image_tasks:
+            found_paths.append(task[1])
+            if journal.is_scored(*task[1:]):
+                num_skipped[0] += 1
+            else:
+                yield task
 
-    print(f"Found {len(image_tasks)} images. Starting assessment...")
+    chunks = iter_chunks(pending_tasks(), args.batch_size)
+    print(f"Scanning {args.manifest or args.input_dir}, images already scored in {journal.path} are skipped...")
 
     # 4. Processing Loop
-    results = []
+    if args.workers > 1:
+        print(f"Starting {args.workers} workers on {', '.join(devices)} ...")
+        batches = run_workers(args, chunks, devices)
+    else:
+        batches = (score_batch(assessment, entries, image_tensors, args.precision, digests)
+                   for entries, image_tensors, digests in prefetch_batches(
+                       chunks, assessment.image_processor, assessment.background_color, args.num_workers,
+                       tensor_store=TensorStore(args.tensor_store, assessment.image_processor)
+                       if args.tensor_store else None,
+                       pin_memory=assessment.model.device.type == "cuda", with_digest=result_cache is not None))
+    start = time.perf_counter()
+    num_scored = 0
 
     # Using tqdm for progress tracking
-    for full_path, rel_path in tqdm(image_tasks, desc="Assessing"):
-        try:
-            # Process image (as per your server logic)
-            img = Image.open(full_path).convert('RGB')
-            input_img = [img]
+    with tqdm(desc="Assessing", unit="img") as progress:
+        for records in batches:
+            journal.append(records)
+            num_scored += sum(record["score"] is not None for record in records)
+            progress.update(len(records))
 
-            # Based on your server.py: returns (comment_list, score_list)
-            answer, score = assessment(input_img, precision=args.precision)
-
-            results.append({
-                "file_path": rel_path,
-                "score": score[0],
-                "comment": answer[0]
-            })
+    if rejected:
+        print(f"\n{len(rejected)} files are not readable images (bad or truncated header), recorded as errors")
+        journal.append([{"file_path": rel_path, "size": size, "mtime_ns": mtime_ns, "score": None,
+                         "comment": "Error: not a readable image (bad or truncated header)"}
+                        for _, rel_path, size, mtime_ns in rejected])
+        found_paths.extend(rel_path for _, rel_path, _, _ in rejected)
+    if not found_paths:
+        print(f"No valid image files found in: {args.manifest or args.input_dir}")
+        journal.close()
+        return
+    print(f"Found {len(found_paths)} images, {num_skipped[0]} already scored.")
+    elapsed = time.perf_counter() - start
+    print(f"Scored {num_scored} images in {elapsed:.1f}s ({num_scored / max(elapsed, 1e-9):.2f} images/s)")
+    if result_cache is not None:
+        print(f"Result cache: {result_cache.stats()}")
+        result_cache.close()
 
-        except Exception as e:
-            print(f"\nError processing {rel_path}: {e}")
-            results.append({
-                "file_path": rel_path,
-                "score": None,
-                "comment": f"Error: {str(e)}"
-            })
-
-    # 5. Save results to JSON
-    with open(final_output_path, 'w', encoding='utf-8') as f:
-        json.dump(results, f, indent=4, ensure_ascii=False)
+    # 5. Save results to JSON, materialised from the journal for the images found in this run
+    journal.write_results(found_paths, final_output_path)
+    journal.close()
 
     print(f"\n✅ Assessment finished! Results saved to: {args.output_json}")
 
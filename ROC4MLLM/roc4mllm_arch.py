@@ -5,8 +5,9 @@ from mplug_owl2.model.builder import load_pretrained_model
 import torch
 from mplug_owl2.conversation import conv_templates
 from mplug_owl2.mm_utils import tokenizer_image_token
+from mplug_owl2.assessor import build_prefill_ids, prefill_score_logits, expected_score, batch_input_ids, \
+    extract_generated_scores
 from typing import List
-import numpy as np
 
 @ARCH_REGISTRY.register()
 class ROC4MLLMArch(nn.Module):
@@ -26,9 +27,15 @@ class ROC4MLLMArch(nn.Module):
         prompt = conv.get_prompt()+'The aesthetic rate of the image is'
         self.input_ids = tokenizer_image_token(prompt, tokenizer, -200, return_tensors='pt').unsqueeze(0).to(
             model.device)
+        # prompt + answer prefix for the single forward "prefill" mode, tokenized as in the training answers
+        self.prefill_ids = build_prefill_ids(conv.get_prompt(), tokenizer, model.config.score_id).unsqueeze(0).to(
+            model.device)
         self.tokenizer = tokenizer
         self.model = model
         self.image_processor = image_processor
+        self.background_color = tuple(int(x * 255) for x in image_processor.image_mean)
+        self.prompt_key = tuple(self.input_ids[0].tolist())
+        self.prefill_key = tuple(self.prefill_ids[0].tolist())
 
     def expand2square(self, pil_img, background_color):
         width, height = pil_img.size
@@ -42,17 +49,26 @@ class ROC4MLLMArch(nn.Module):
             result = Image.new(pil_img.mode, (height, height), background_color)
             result.paste(pil_img, ((height - width) // 2, 0))
             return result
-    def forward(self, image):
+    def forward(self, image, mode="comment"):
         #输入为图像list，图像为pil类型
         #输出为分数和文本，均为list类型
-        image = [self.expand2square(img, tuple(int(x * 255) for x in self.image_processor.image_mean)) for img in image]
+        #mode="prefill"时只做一次前向，直接读取[SCORE]位置的分数，不生成评论
+        if mode not in ("comment", "prefill"):
+            raise ValueError(f"Unknown mode: {mode}")
+        image = [self.expand2square(img, self.background_color) for img in image]
         with torch.inference_mode():
             image_tensors = self.image_processor.preprocess(image, return_tensors='pt')['pixel_values'].half().to(
                 self.model.device)
+            if mode == "prefill":
+                scores = expected_score(
+                    prefill_score_logits(self.model, self.prefill_ids, image_tensors, self.prefill_key),
+                    self.model.get_score_weights())
+                output_score = [round(score, 4) for score in scores.tolist()]
+                return output_score, [f"The aesthetic rate of the image is {score}." for score in output_score]
             # print(image_tensors.shape)
             # print(torch.cat(image_tensors, 0).shape)
             outputs = self.model.generate(
-                self.input_ids.repeat(len(image_tensors), 1),
+                batch_input_ids(self.model, self.input_ids, len(image_tensors), self.prompt_key),
                 images=image_tensors,
                 do_sample=False,
                 max_new_tokens=512,
@@ -61,38 +77,21 @@ class ROC4MLLMArch(nn.Module):
                 return_dict_in_generate=True,
                 output_scores=True,
             )
+            prompt_len = self.input_ids.shape[1]
+            score_logits, index, has_score = extract_generated_scores(
+                outputs, prompt_len, self.model.config.score_id, self.model.config.img_token_num)
+            scores = expected_score(score_logits, self.model.get_score_weights())
+            output_ids = outputs.sequences[:, prompt_len:].tolist()
             output_text = []
             output_score = []
-            logits = outputs.scores
-            # print(len(image_tensors))
-            for i in range(len(image_tensors)):
-                output_ids = outputs.sequences[i]
-                # special_token_index = (
-                #         (output_ids >= self.model.config.output_first_id) & (
-                #         output_ids <= self.model.config.output_last_id)).nonzero()
-                special_token_index = (output_ids == self.model.config.score_id).nonzero()
-                if len(special_token_index):
-                    index = special_token_index[0, 0]
-                    input_embedding = logits[index - self.input_ids.shape[1]][i,
-                                      -self.model.config.img_token_num:].view(1, -1)
-                    score = torch.softmax(input_embedding, dim=1)
-                    w = torch.from_numpy(
-                        np.linspace(self.model.config.min_score, self.model.config.max_score,
-                                    self.model.config.num_tokens)).to(
-                        score.device)
-                    w = w.type(torch.FloatTensor)
-                    w_batch = w.repeat(score.size(0), 1).to(score.device)
-
-                    score = (score * w_batch).sum(dim=1)
-                    text1 = self.tokenizer.decode(output_ids[self.input_ids.shape[1]:index], skip_special_tokens=True)
-                    text2 = self.tokenizer.decode(output_ids[index + 1:], skip_special_tokens=True)
-                    pred_text = text1 + f" {round(float(score), 4)} " + text2
-                    output_text.append(pred_text)
-                    output_score.append(round(float(score), 4))
-
+            for ids, idx, scored, score in zip(output_ids, index.tolist(), has_score.tolist(), scores.tolist()):
+                if scored:
+                    score = round(score, 4)
+                    text1 = self.tokenizer.decode(ids[:idx], skip_special_tokens=True)
+                    text2 = self.tokenizer.decode(ids[idx + 1:], skip_special_tokens=True)
+                    output_text.append(text1 + f" {score} " + text2)
+                    output_score.append(score)
                 else:
-                    pred_text = self.tokenizer.decode(output_ids[self.input_ids.shape[1]:],
-                                                      skip_special_tokens=True).strip()
-                    output_text.append(pred_text)
+                    output_text.append(self.tokenizer.decode(ids, skip_special_tokens=True).strip())
                     output_score.append(-1)
         return output_score,output_text
\ No newline at end of file
@@ -1,52 +1,210 @@
 import os
-import tempfile
+import json
+import asyncio
+import tarfile
+import zipfile
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, UploadFile, File
+from fastapi.responses import JSONResponse, StreamingResponse
 from mplug_owl2.assessor import Assessment
+from mplug_owl2.batching import BatchScheduler
+from mplug_owl2.result_cache import ResultCache, CachedAssessment
+from mplug_owl2.mm_utils import load_image_from_bytes
 from PIL import Image
 
+# uploads are rejected before decoding if they exceed these limits
+MAX_UPLOAD_BYTES = int(os.environ.get("ROC4MLLM_MAX_UPLOAD_MB", 20)) * 1024 * 1024
+MAX_IMAGE_PIXELS = int(os.environ.get("ROC4MLLM_MAX_IMAGE_PIXELS", 64_000_000))
+# limits of /api/roc4mllm/batch: size of each uploaded file or archive, size and number of all the uploaded
+# files of a request, and images per request
+MAX_ARCHIVE_BYTES = int(os.environ.get("ROC4MLLM_MAX_ARCHIVE_MB", 1024)) * 1024 * 1024
+MAX_REQUEST_BYTES = int(os.environ.get("ROC4MLLM_MAX_REQUEST_MB", 2048)) * 1024 * 1024
+MAX_BATCH_FILES = int(os.environ.get("ROC4MLLM_MAX_BATCH_FILES", 1000))
+MAX_BATCH_IMAGES = int(os.environ.get("ROC4MLLM_MAX_BATCH_IMAGES", 10000))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
 assessment=Assessment(pretrained="models")
+# results of previously seen images, keyed by their pixels, the checkpoint and the prompt
+result_cache = None
+if os.environ.get("ROC4MLLM_CACHE", "0") == "1":
+    result_cache = ResultCache(max_entries=int(os.environ.get("ROC4MLLM_CACHE_ENTRIES", 10000)),
+                               path=os.environ.get("ROC4MLLM_CACHE_PATH") or None,
+                               max_disk_mb=float(os.environ.get("ROC4MLLM_CACHE_MB", 1024)))
+    assessment = CachedAssessment(assessment, result_cache)
+
+
+def assess_batch(images):
+    answer, score = assessment(images, precision=4)
+    return list(zip(answer, score))
+
+
+# concurrent requests are scored together, one forward per batch on the scheduler's worker thread
+scheduler = BatchScheduler(
+    assess_batch,
+    max_batch_size=int(os.environ.get("ROC4MLLM_MAX_BATCH_SIZE", 16)),
+    max_wait_ms=float(os.environ.get("ROC4MLLM_MAX_WAIT_MS", 10)),
+)
+
+# images are decoded from the request bytes off the event loop, at most this many at a time
+decode_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("ROC4MLLM_DECODE_WORKERS", 4)),
+                                 thread_name_prefix="decode")
 
 app = FastAPI(title="ROC4MLLM")
 
 
+@app.on_event("shutdown")
+def shutdown():
+    scheduler.close()
+    decode_pool.shutdown()
+    if result_cache is not None:
+        result_cache.close()
+
+
+@app.get("/api/metrics")
+async def metrics():
+    result = scheduler.metrics()
+    if result_cache is not None:
+        result["cache"] = result_cache.stats()
+    return result
+
+
+def iter_upload_images(filename, fileobj):
+    # (name, bytes) of an uploaded image, or of every image in an uploaded zip or tar archive, read from the
+    # upload's spooled file so that an archive is never held in memory. Members are read up to one byte past the
+    # size limit, so oversized ones are rejected without inflating them fully.
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    with archive.open(info) as member:
+                        yield info.filename, member.read(MAX_UPLOAD_BYTES + 1)
+    elif filename.lower().endswith(TAR_EXTENSIONS):
+        fileobj.seek(0)
+        with tarfile.open(fileobj=fileobj, mode="r:*") as archive:
+            for info in archive:
+                if info.isfile() and info.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield info.name, archive.extractfile(info).read(MAX_UPLOAD_BYTES + 1)
+    else:
+        fileobj.seek(0)
+        yield filename, fileobj.read(MAX_UPLOAD_BYTES + 1)
+
+
+def upload_size(fileobj):
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+
+async def score_image_bytes(contents):
+    # (status code, response body) of one encoded image, shared by the single and batch endpoints
+    if len(contents) > MAX_UPLOAD_BYTES:
+        return 413, {"error": f"file is larger than {MAX_UPLOAD_BYTES} bytes"}
+    try:
+        img = await asyncio.get_running_loop().run_in_executor(
+            decode_pool, load_image_from_bytes, contents, MAX_IMAGE_PIXELS)
+    except (ValueError, Image.DecompressionBombError) as e:
+        return 413, {"error": str(e)}
+    except Exception as e:
+        return 400, {"error": f"cannot decode image: {e}"}
+
+    try:
+        answer, score = await asyncio.wrap_future(scheduler.submit(img))
+        return 200, {"score": score, "comment": answer}
+    except Exception as e:
+        return 500, {"error": str(e)}
+
+
 @app.post("/api/roc4mllm")
 async def score_roc4mllm(file: UploadFile = File(...)):
     if not file.filename:
         return JSONResponse(content={"error": "未选择文件"}, status_code=400)
 
-    temp_file_path = None  # 初始化变量
-    try:
-        # 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-            # 读取上传文件内容并写入临时文件
-            contents = await file.read()
-            tmp_file.write(contents)
-            temp_file_path = tmp_file.name
-
-        # ref_cc, model = color_eval_init()
+    status, result = await score_image_bytes(await file.read(MAX_UPLOAD_BYTES + 1))
+    if status != 200:
+        return JSONResponse(content=result, status_code=status)
+    return result
 
-        # 使用临时文件路径调用评估函数
-        # result = eval_sbj_img_color(temp_file_path, model, threshold)
 
-        img = Image.open(temp_file_path).convert('RGB')
-        input_img=[img]
-        answer,score = assessment(input_img, precision=4)
+async def archive_error(e):
+    return 400, {"error": f"cannot read archive: {e}"}
 
-        result = {"score":score[0], "comment": answer[0]}
 
-        # 转换为JSON字符串
-        # json_result = json.dumps(result, ensure_ascii=False, indent=2)
-        # print(json_result)
+async def stream_batch_results(uploads):
+    # Every image is decoded and submitted as soon as it is read, so the scheduler forms model-sized
+    # batches from them. Results are written in upload order, one JSON line per image, a batch at a time;
+    # at most two batches are in flight to bound the memory held by decoded images.
+    batch_size = scheduler.max_batch_size
+    pending = []
 
-        # 或者直接返回字典（如果是API响应）
-        return result
+    async def drain(count):
+        lines = []
+        for name, task in pending[:count]:
+            status, result = await task
+            lines.append(json.dumps({"file": name, "status": status, **result}, ensure_ascii=False) + "\n")
+        del pending[:count]
+        return "".join(lines)
 
-    except Exception as e:
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+    images = reading = None
+    try:
+        num_images = 0
+        for filename, fileobj in uploads:
+            # the uploads are read one at a time, and every step of the archive iteration (detection, member
+            # reads, inflation) runs on the decode pool rather than on the event loop
+            images = iter_upload_images(filename, fileobj)
+            try:
+                while True:
+                    reading = decode_pool.submit(next, images, None)
+                    item = await asyncio.wrap_future(reading)
+                    if item is None:
+                        break
+                    num_images += 1
+                    if num_images > MAX_BATCH_IMAGES:
+                        break
+                    name, contents = item
+                    pending.append((name, asyncio.ensure_future(score_image_bytes(contents))))
+                    if len(pending) >= 2 * batch_size:
+                        yield await drain(batch_size)
+            except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+                pending.append((filename, asyncio.ensure_future(archive_error(e))))
+            images.close()
+            if num_images > MAX_BATCH_IMAGES:
+                break
+        while pending:
+            yield await drain(batch_size)
+        if num_images > MAX_BATCH_IMAGES:
+            yield json.dumps({"status": 413, "error": f"more than {MAX_BATCH_IMAGES} images in one request, "
+                                                      f"the rest were not scored"}) + "\n"
     finally:
-        # 确保删除临时文件
-        if temp_file_path is not None and os.path.exists(temp_file_path):
-            os.unlink(temp_file_path)
-
+        # the client went away: stop the requests that were not scored yet
+        for _, task in pending:
+            task.cancel()
+        if reading is not None and not reading.done():
+            # a member is still being read on the decode pool: close the archive once that read returns
+            reading.add_done_callback(lambda _: images.close())
+        elif images is not None:
+            images.close()
 
 
+@app.post("/api/roc4mllm/batch")
+async def score_roc4mllm_batch(files: List[UploadFile] = File(...)):
+    # Any number of images and zip/tar archives of images, up to the limits above. The response is NDJSON, one
+    # {"file", "status", "score", "comment"} or {"file", "status", "error"} line per image.
+    if len(files) > MAX_BATCH_FILES:
+        return JSONResponse(content={"error": f"more than {MAX_BATCH_FILES} files in one request"}, status_code=413)
+    uploads = []
+    total_bytes = 0
+    for file in files:
+        size = upload_size(file.file)
+        if size > MAX_ARCHIVE_BYTES:
+            return JSONResponse(content={"error": f"{file.filename} is larger than {MAX_ARCHIVE_BYTES} bytes"},
+                                status_code=413)
+        total_bytes += size
+        if total_bytes > MAX_REQUEST_BYTES:
+            return JSONResponse(content={"error": f"the files are larger than {MAX_REQUEST_BYTES} bytes in total"},
+                                status_code=413)
+        uploads.append((file.filename or "", file.file))
+    return StreamingResponse(stream_batch_results(uploads), media_type="application/x-ndjson")